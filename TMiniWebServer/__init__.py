@@ -1,2 +1,4 @@
 from .tminiwebserver import *
 from .tminiwebserver_util import *
+from .tminiwebserver_multipart import *
+from .tminiwebserver_metrics import *
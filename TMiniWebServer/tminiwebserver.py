@@ -1,83 +1,629 @@
 import uasyncio as asyncio
 import socket
 import sys
-import re
 import gc
 import binascii
 import hashlib
+from time import ticks_ms, ticks_diff, ticks_add
 from json import loads, dumps
-from .tminiwebserver_util import TMiniWebServerUtil, HttpStatusCode
+from .tminiwebserver_util import TMiniWebServerUtil, TMiniWebQueryParams, HttpStatusCode
+from .tminiwebserver_multipart import TMiniWebMultipartReader
+from .tminiwebserver_metrics import TMiniWebMetrics, _MetricsStream
+from .tminiwebserver_logger import TMiniWebLogger
+
+## ルートパラメーターの変換関数. 一致しない場合は例外ではなく None を返す.
+def _convert_route_int(value):
+    return int(value) if value.isdigit() else None
+
+def _convert_route_hex(value):
+    if value and not value.strip('0123456789abcdefABCDEF'):
+        return int(value, 16)
+    return None
+
+def _convert_route_str(value):
+    return value if value else None
+
+def _websocket_unmask(buf, length, mask):
+    ## 受信したペイロードのマスクをその場で解除する. 剰余を避けて 4 バイトずつ処理.
+    m0, m1, m2, m3 = mask[0], mask[1], mask[2], mask[3]
+    end = length & ~3
+    for i in range(0, end, 4):
+        buf[i] ^= m0
+        buf[i + 1] ^= m1
+        buf[i + 2] ^= m2
+        buf[i + 3] ^= m3
+    for i in range(end, length):
+        buf[i] ^= mask[i & 3]
+
+try:
+    from .tminiwebserver_native import websocket_unmask as _websocket_unmask
+except:
+    pass
+
+async def _wait(coro, timeout):
+    ## timeout が 0 なら待ち時間を制限しない.
+    if timeout:
+        return await asyncio.wait_for(coro, timeout)
+    return await coro
 
 class _WebServerRoute:
-    def __init__(self, route, method, func, route_arg_names, routeRegex):
+    def __init__(self, route, method, func, route_arg_names, route_arg_converters, options = None):
         self.route = route
         self.method = method
         self.func = func
         self.route_arg_names = route_arg_names
-        self.route_regex = routeRegex
+        self.route_arg_converters = route_arg_converters
+        self.options = options
+
+class _WebServerRouteNode:
+    ## パラメーター付きルートを探索するためのセグメント単位のトライ木のノード.
+    def __init__(self):
+        self.children = { }     ## 固定セグメント -> _WebServerRouteNode
+        self.params = [ ]       ## (型名, 変換関数, _WebServerRouteNode) を優先順に保持
+        self.routes = None      ## メソッド -> _WebServerRoute
+
+class _StaticFileEntry:
+    def __init__(self, file_path, mime_type, size, data, headers):
+        self.file_path = file_path
+        self.mime_type = mime_type
+        self.size = size
+        self.data = data        ## キャッシュ対象のサイズ以下のときだけファイルの内容を保持する.
+        self.headers = headers  ## etag, last-modified, cache-control などの応答ヘッダ.
+        self.gzip = None        ## 隣に置かれた圧縮済みファイル(.gz)の _StaticFileEntry.
+        self.last_used = 0
+
+class _BufferPool:
+    ## ファイル送信に使うバッファをあらかじめ確保して使い回す.
+    ## 空いているバッファが無いときは返却されるまで wait_timeout 秒待ち、
+    ## それでも空かなければ一時的なバッファを確保する. 遅いクライアントに他の送信を止めさせないため.
+    def __init__(self, count, size, wait_timeout):
+        self.size = size
+        self.count = count
+        self.wait_timeout = wait_timeout
+        self._buffers = [bytearray(size) for _ in range(count)]
+        self._released = asyncio.Event()
+
+    async def acquire(self):
+        if self._buffers:
+            return self._buffers.pop()
+        try:
+            await _wait(self._wait_released(), self.wait_timeout)
+        except asyncio.TimeoutError:
+            TMiniWebServer.dlog('file buffer is busy. allocate temporary buffer')
+            return bytearray(self.size)
+        return self._buffers.pop()
+
+    async def _wait_released(self):
+        while not self._buffers:
+            self._released.clear()
+            await self._released.wait()
+
+    def release(self, buffer):
+        ## 一時的に確保したバッファは、プールが埋まっていれば捨てる.
+        if len(self._buffers) < self.count:
+            self._buffers.append(buffer)
+            self._released.set()
+
+class _ConnectionReader:
+    ## 接続毎の読み込み. リクエストヘッダはあらかじめ確保したバッファへ読み込み、
+    ## 読み過ぎた分(ボディやパイプライン化された次のリクエスト)は後の読み込みで返す.
+
+    def __init__(self, stream, head_buffer_size):
+        self._stream = stream
+        self._pending = None
+        self._pending_pos = 0
+        self._head_buffer = bytearray(head_buffer_size)
+
+    def _unread(self, data):
+        if data:
+            self._pending = data
+            self._pending_pos = 0
+
+    def _take(self, size):
+        pos = self._pending_pos
+        data = self._pending[pos:pos + size]
+        pos += len(data)
+        if pos >= len(self._pending):
+            self._pending = None
+            pos = 0
+        self._pending_pos = pos
+        return data
+
+    async def read_head(self, idle_timeout = 0, head_timeout = 0):
+        ## ヘッダの終端(空行)までを bytes で返す. 終端の前に接続が閉じられると None.
+        ## バッファに収まらなければ途中までの内容を返し、complete が False になる.
+        ## 最初のデータを idle_timeout 秒待っても来なければ None を返し、
+        ## 来てから head_timeout 秒以内に終端まで届かなければ asyncio.TimeoutError になる.
+        view = memoryview(self._head_buffer)
+        size = 0
+        if self._pending is not None:
+            data = self._take(len(view))
+            size = len(data)
+            view[:size] = data
+        else:
+            try:
+                size = await _wait(self._stream.readinto(view), idle_timeout)
+            except asyncio.TimeoutError:
+                return None, False
+            if not size:
+                return None, False
+        return await _wait(self._read_head_rest(view, size), head_timeout)
+
+    async def _read_head_rest(self, view, size):
+        scanned = 0
+        while True:
+            if size > scanned:
+                lo = scanned - 3 if scanned > 3 else 0
+                data = bytes(view[lo:size])
+                ## 終端は空行. 改行が LF だけのリクエストも受け付ける.
+                index = data.find(b'\n\r\n')
+                length = 3
+                lf_index = data.find(b'\n\n', 0, index if index >= 0 else len(data))
+                if lf_index >= 0:
+                    index = lf_index
+                    length = 2
+                if index >= 0:
+                    end = lo + index + length
+                    if end < size:
+                        self._unread(bytes(view[end:size]))
+                    head = data[:index + length] if lo == 0 else bytes(view[:end])
+                    if head.count(b'\n') != head.count(b'\r\n'):
+                        ## 以降の解析は CRLF を前提にしているので、LF だけの改行を揃える.
+                        head = head.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+                    return head, True
+                scanned = size
+            if size == len(view):
+                return bytes(view[:size]), False
+            read_size = await self._stream.readinto(view[size:])
+            if not read_size:
+                return None, False
+            size += read_size
+
+    async def read(self, size = -1):
+        if self._pending is not None:
+            return self._take(size if size >= 0 else len(self._pending))
+        return await self._stream.read(size)
+
+    async def readinto(self, buffer):
+        if self._pending is not None:
+            data = self._take(len(buffer))
+            buffer[:len(data)] = data
+            return len(data)
+        return await self._stream.readinto(buffer)
+
+    async def readexactly(self, size):
+        if self._pending is None:
+            return await self._stream.readexactly(size)
+        data = self._take(size)
+        if len(data) < size:
+            data += await self._stream.readexactly(size - len(data))
+        return data
+
+    async def readline(self):
+        if self._pending is None:
+            return await self._stream.readline()
+        index = self._pending.find(b'\n', self._pending_pos)
+        if index >= 0:
+            return self._take(index + 1 - self._pending_pos)
+        data = self._take(len(self._pending))
+        return data + await self._stream.readline()
+
+class _RequestHeaders:
+    ## リクエストヘッダ. 解析時には名前と値の位置だけを記録し、
+    ## 値は参照されたときに初めて文字列にする.
+    def __init__(self, head, start, end):
+        self._head = head
+        self._index = { }
+        self._values = { }
+        pos = start
+        while pos < end:
+            line_end = head.find(b'\r\n', pos, end)
+            if line_end < 0:
+                line_end = end
+            colon = head.find(b':', pos, line_end)
+            if colon <= pos:
+                raise ValueError('invalid header line')
+            self._index[head[pos:colon].strip().lower().decode()] = (colon + 1, line_end)
+            pos = line_end + 2
+
+    def get(self, name, default = None):
+        value = self._values.get(name, None)
+        if value is None:
+            pos = self._index.get(name, None)
+            if pos is None:
+                return default
+            value = self._head[pos[0]:pos[1]].strip().decode()
+            self._values[name] = value
+        return value
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+    def items(self):
+        return [(name, self.get(name)) for name in self._index]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+class _StaticFileCache:
+    ## リクエストパスをキーにスタティックファイルの情報を保持する LRU キャッシュ.
+    ## 保持する内容とエントリ毎の管理分の合計が max_bytes を超えないよう古いものから捨てる.
+    _ENTRY_OVERHEAD = 64
+
+    def __init__(self, max_bytes, max_file_size):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = { }
+        self._tick = 0
+
+    def get(self, key):
+        entry = self._entries.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._tick += 1
+        entry.last_used = self._tick
+        return entry
+
+    def put(self, key, entry):
+        cost = self._get_cost(key, entry)
+        if cost > self.max_bytes:
+            return
+        self.remove(key)
+        while self._entries and self.used_bytes + cost > self.max_bytes:
+            self._evict()
+        self._tick += 1
+        entry.last_used = self._tick
+        self._entries[key] = entry
+        self.used_bytes += cost
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.used_bytes -= self._get_cost(key, entry)
+
+    def clear(self):
+        self._entries.clear()
+        self.used_bytes = 0
+
+    def _evict(self):
+        lru_key = None
+        lru_tick = 0
+        for key in self._entries:
+            entry = self._entries[key]
+            if lru_key is None or entry.last_used < lru_tick:
+                lru_key = key
+                lru_tick = entry.last_used
+        self.remove(lru_key)
+
+    def _get_cost(self, key, entry):
+        cost = self._ENTRY_OVERHEAD + len(key)
+        while entry is not None:
+            cost += len(entry.file_path)
+            if entry.data is not None:
+                cost += len(entry.data)
+            entry = entry.gzip
+        return cost
+
+class _CachedResponse:
+    def __init__(self, path, expires, head, tail, content):
+        self.path = path
+        self.expires = expires  ## ticks_ms
+        self.head = head        ## ステータス行から connection ヘッダの前まで
+        self.tail = tail        ## connection ヘッダの後からヘッダの終わりまで
+        self.content = content
+
+class _ResponseCache:
+    ## cache_ttl を指定したルートの応答を、エンコード済みのまま保持する.
+    ## 期限切れのものを捨て、それでも max_bytes を超えるなら期限の近いものから捨てる.
+    _ENTRY_OVERHEAD = 64
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = { }
+
+    def get(self, key):
+        entry = self._entries.get(key, None)
+        if entry is not None and ticks_diff(entry.expires, ticks_ms()) <= 0:
+            self.remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        cost = self._get_cost(key, entry)
+        if cost > self.max_bytes:
+            return
+        self.remove(key)
+        self._evict(cost)
+        self._entries[key] = entry
+        self.used_bytes += cost
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.used_bytes -= self._get_cost(key, entry)
+
+    def invalidate(self, path = None):
+        ## path を省略するとすべて捨てる.
+        for key in [k for k, e in self._entries.items() if path is None or e.path == path]:
+            self.remove(key)
+
+    def _evict(self, cost):
+        now = ticks_ms()
+        for key in [k for k, e in self._entries.items() if ticks_diff(e.expires, now) <= 0]:
+            self.remove(key)
+        while self._entries and self.used_bytes + cost > self.max_bytes:
+            first_key = None
+            first_expires = None
+            for key, entry in self._entries.items():
+                if first_key is None or ticks_diff(entry.expires, first_expires) < 0:
+                    first_key = key
+                    first_expires = entry.expires
+            self.remove(first_key)
+
+    def _get_cost(self, key, entry):
+        return self._ENTRY_OVERHEAD + len(key) + len(entry.head) + len(entry.tail) + len(entry.content)
 
 class TMiniWebServer:
     _decorate_route_handlers = []
+    _decorate_before_request_handlers = []
+    _decorate_after_request_handlers = []
+    _decorate_error_handlers = []
     debug = 0
-    gc_after_filesend = 1   ## ファイル送信後にGC発動しておくためのフラグ.
+    gc_after_filesend = 0   ## ファイル送信後にGC発動しておくためのフラグ. 送信バッファは使い回すので通常は不要.
+    file_buffer_size = 4 * 1024 ## ファイル送信に使うバッファのサイズ.
+    file_buffer_count = 0       ## 送信バッファの数. 0 で max_connections と同じ数(無制限のときは 2).
+    file_buffer_wait_timeout = 1    ## 送信バッファの空きを待つ時間(秒). 超えると一時的なバッファを確保する.
+    response_coalesce_size = 1024   ## この大きさ以下のボディはヘッダとまとめて1回で送る.
+    max_request_body_size = 0   ## 受け付けるリクエストボディの最大サイズ. 0 で無制限.
+    max_request_line = 1024     ## リクエスト行の最大長. 超えると 414.
+    max_header_size = 2048      ## ヘッダ部分の最大長. 超えると 431.
+    max_header_count = 32       ## ヘッダの最大数. 超えると 431.
+    request_head_timeout = 10   ## 接続してから、またはヘッダを受信し始めてから終端までを待つ時間(秒). 超えると 408.
+    request_body_timeout = 10   ## ボディの続きを待つ時間(秒). 超えると 408.
+    keep_alive = 1              ## HTTP/1.1 の持続的接続(Keep-Alive)を有効にするフラグ.
+    keep_alive_max_requests = 16    ## 1つの接続で処理するリクエストの最大数.
+    keep_alive_timeout = 5      ## 次のリクエストを待つ時間(秒). 超過すると接続を閉じる.
+    websocket_timeout = 0       ## WebSocket で何も受信しないまま待つ時間(秒). 超えると閉じる. 0 で無制限.
+    websocket_max_frame_size = 16 * 1024    ## 受信する WebSocket フレームの最大サイズ. 超えると閉じる.
+    websocket_max_message_size = 32 * 1024  ## 分割されたフレームを結合したメッセージの最大サイズ.
+    websocket_queue_size = 8    ## チャンネル配信でクライアント毎に溜めておくフレームの最大数.
+    websocket_queue_policy = 0  ## キューが一杯のとき. 0: 古いものを捨てる, 1: 接続を閉じる (TMiniWebSocketHub.DROP_OLDEST/DISCONNECT).
+    websocket_ping_interval = 0 ## 受信が無いとき PING を送る間隔(秒). 0 で送らない. with_websocket で個別に指定できる.
+    websocket_pong_timeout = 10 ## PING を送ってから PONG を待つ時間(秒). 超えると切断する.
+    logger = TMiniWebLogger()
+    log_level = TMiniWebLogger.INFO         ## これより低いレベルのログは記録しない.
+    log_print_level = TMiniWebLogger.WARNING    ## これ以上のレベルのログはすぐに表示する. 他はリングバッファにだけ残す.
+    log_ring_size = 32          ## リングバッファに残すログの数.
+    log_file = None             ## ログを追記するファイル. 送信の合間にバックグラウンドのタスクでまとめて書き出す.
+    log_flush_interval = 10     ## ログをファイルへ書き出す間隔(秒).
+    log_path = None             ## リングバッファのログを返すパス. None で返さない.
+    metrics_enabled = 0         ## リクエスト数やレイテンシなどを集計するフラグ.
+    metrics_path = '/metrics'   ## 集計結果を返すパス. None で返さない. '?format=json' で JSON.
+    response_cache_size = 8 * 1024  ## cache_ttl を指定したルートの応答のキャッシュに使うメモリ(バイト). 0 で無効.
+    event_stream_replay_size = 8    ## Server-Sent Events で再接続時に送り直すために残しておくイベントの数.
+    event_stream_heartbeat = 15     ## Server-Sent Events で何も送らないときにコメントを送る間隔(秒).
+    event_stream_queue_size = 8     ## Server-Sent Events でクライアント毎に溜めておくイベントの最大数.
+    static_cache_size = 0       ## スタティックファイルのキャッシュに使うメモリ(バイト). 0 で無効.
+    static_cache_max_file_size = 2048   ## 内容までキャッシュするファイルの最大サイズ.
+    ## スタティックファイルの cache-control ヘッダ. '/static/' のようなディレクトリ指定を
+    ## '.js' のような拡張子指定より優先し、どちらにも一致しなければ cache_control_default を使う.
+    cache_control = { }
+    cache_control_default = None
+    static_gzip = 1             ## 'foo.js' に対して 'foo.js.gz' があれば gzip のまま送るフラグ.
+    backlog = 5                 ## listen の backlog.
+    max_connections = 0         ## 同時に処理する HTTP の接続の最大数. 0 で無制限. WebSocket と Server-Sent Events の接続は数えない.
+    connection_wait_timeout = 3 ## 上限に達しているとき空きを待つ時間(秒). 0 ですぐに 503 を返す.
+    retry_after = 5             ## 503 を返すときの retry-after (秒).
+    min_free_memory = 0         ## 空きメモリがこれを下回ると新しい接続を 503 で断る. 0 で無効.
 
     @classmethod
-    def route(cls, url_path, method='GET'):
+    def route(cls, url_path, method='GET', cache_ttl = 0, cache_query = ()):
+        ## cache_ttl(秒) を指定すると GET の応答をキャッシュする. キーはパスと cache_query に挙げたクエリパラメーター.
+        ## キャッシュされるのは write_response で返した 200 の応答だけ.
         def route_decorator(func):
-            item = (url_path, method, func)
+            options = { 'cache_ttl': cache_ttl, 'cache_query': cache_query } if cache_ttl else None
+            item = (url_path, method, func, options)
             cls._decorate_route_handlers.append(item)
             return func
         return route_decorator
     
     @classmethod
-    def with_websocket(cls, url_path):
+    def with_websocket(cls, url_path, ping_interval = None, pong_timeout = None):
+        ## ping_interval, pong_timeout を省略するとクラス属性の値を使う.
         def websocket_decorator(func):
-            item = (url_path, 'websocket', func)
+            options = { 'ping_interval': ping_interval, 'pong_timeout': pong_timeout }
+            item = (url_path, 'websocket', func, options)
             cls._decorate_route_handlers.append(item)
             return func
         return websocket_decorator
+
+    @classmethod
+    def before_request(cls, func):
+        ## ルーティングの前に func(client) を呼ぶ. 応答を返すとそこで打ち切り、ハンドラーは呼ばない.
+        cls._decorate_before_request_handlers.append(func)
+        return func
+
+    @classmethod
+    def after_request(cls, func):
+        ## 応答を返した後に func(client) を呼ぶ.
+        cls._decorate_after_request_handlers.append(func)
+        return func
+
+    @classmethod
+    def on_error(cls, func):
+        ## ハンドラーが例外を送出したときに func(client, ex) を呼ぶ. まだ応答していなければここで返せる.
+        cls._decorate_error_handlers.append(func)
+        return func
+
+    @classmethod
+    def event_stream(cls, url_path, replay_size = None):
+        ## Server-Sent Events のエンドポイント. ハンドラーは接続時に TMiniWebEventStream を受け取り、
+        ## 抜けた後も接続は残って publish_event で配信されるイベントを送り続ける.
+        def event_stream_decorator(func):
+            options = { 'event_stream': True, 'replay_size': replay_size }
+            item = (url_path, 'GET', func, options)
+            cls._decorate_route_handlers.append(item)
+            return func
+        return event_stream_decorator
     
     @staticmethod
-    def log(message):
-        print(f"[log] {message}")
+    def log(message, *args):
+        ## メッセージは '%' 形式で、引数の文字列化は記録するときまで行わない.
+        TMiniWebServer.logger.info(message, *args)
 
     @staticmethod
-    def dlog(message):
+    def elog(message, *args):
+        TMiniWebServer.logger.warning(message, *args)
+
+    @staticmethod
+    def dlog(message, *args):
+        ## debug が 1 のときだけ記録して表示する.
         if TMiniWebServer.debug == 1:
-            print(f"[debug] {message}")
+            TMiniWebServer.logger._emit(TMiniWebLogger.DEBUG, message, args, True)
 
     def __init__(self, port = 80, bindIP = '0.0.0.0', wwwroot = '/wwwroot'):
         self._server_ip = bindIP
         self._server_port = port
         self._wwwroot = wwwroot
         self._running = False
-        self._route_handlers = []
+        ## パラメーターを含まないルートはパスで直接引き、含むものはトライ木で探索する.
+        self._static_routes = { }   ## パス -> { メソッド: _WebServerRoute }
+        self._route_tree = _WebServerRouteNode()
+        self._event_channels = { }  ## event_stream のパス -> _EventChannel
         self._add_route_item(self._decorate_route_handlers)
+        ## ミドルウェアは登録順のタプルにしておく. 無ければ判定1回だけで素通りさせる.
+        self._before_request = tuple(self._decorate_before_request_handlers)
+        self._after_request = tuple(self._decorate_after_request_handlers)
+        self._error_handlers = tuple(self._decorate_error_handlers) or None
+        self._use_middleware = len(self._before_request) > 0 or len(self._after_request) > 0
+        TMiniWebServer.logger.configure(self.log_level, self.log_print_level, self.log_ring_size)
+        if self.log_path:
+            self._add_route_item([(self.log_path, 'GET', self._write_log, None)])
+        self.metrics = None
+        if self.metrics_enabled:
+            self.metrics = TMiniWebMetrics()
+            self.metrics._server = self
+            if self.metrics_path:
+                self._add_route_item([(self.metrics_path, 'GET', self._write_metrics, None)])
+        file_buffer_count = self.file_buffer_count or self.max_connections or 2
+        self._file_buffers = _BufferPool(file_buffer_count, self.file_buffer_size, self.file_buffer_wait_timeout)
+        self.static_cache = None
+        if self.static_cache_size > 0:
+            self.static_cache = _StaticFileCache(self.static_cache_size, self.static_cache_max_file_size)
+        self._connection_count = 0
+        self._connection_waiters = 0
+        self._connection_released = asyncio.Event()
+        ## 負荷が高いときはメモリを使わずに済むよう、応答全体をあらかじめ作っておく.
+        self._busy_response = (f'HTTP/1.1 503 Service Unavailable\r\nserver: TMiniWebServer\r\n'
+            f'retry-after: {self.retry_after}\r\nconnection: close\r\ncontent-length: 0\r\n\r\n').encode()
+        self.websocket_hub = TMiniWebSocketHub(self.websocket_queue_size, self.websocket_queue_policy)
+        self._ping_scheduler = _WebSocketPingScheduler()
+        self.response_cache = None
+        if self.response_cache_size > 0:
+            self.response_cache = _ResponseCache(self.response_cache_size)
     
+    @staticmethod
+    def _parse_route_param(segment):
+        ## '<int:id>' -> ('int', 'id'). 型の指定がなければ str として扱う.
+        elements = segment[1:-1].split(':', 1)
+        if len(elements) == 2:
+            return elements[0], elements[1]
+        return 'str', elements[0]
+
     def _add_route_item(self, source_decorators):
-        for url_path, method, func in source_decorators:
-            route_parts = url_path.split('/')
+        for item in source_decorators:
+            url_path, method, func = item[0], item[1], item[2]
+            options = item[3] if len(item) > 3 else None
+            route_parts = [s for s in url_path.split('/') if s]
             route_arg_names = [ ]
-            route_regex = ''
+            route_arg_converters = [ ]
+            route_arg_types = [ ]
             for s in route_parts:
                 if s.startswith('<') and s.endswith('>'):
-                    route_arg_names.append(s[1:-1])
-                    route_regex += '/(\\w*)'
-                elif s:
-                    route_regex += '/' + s
-            route_regex += '$'
-            TMiniWebServer.dlog(f"  url_path:{url_path} -> regex: {route_regex}")
-            route_regex = re.compile(route_regex)
-            self._route_handlers.append(_WebServerRoute(url_path, method.upper(), func, route_arg_names, route_regex))
-            TMiniWebServer.dlog(f'route add: {url_path}, {route_arg_names}')
+                    arg_type, arg_name = self._parse_route_param(s)
+                    if arg_type not in TMiniWebServer._route_converters:
+                        raise ValueError(f'unknown route parameter type: {s} in {url_path}')
+                    route_arg_types.append(arg_type)
+                    route_arg_names.append(arg_name)
+                    route_arg_converters.append(TMiniWebServer._route_converters[arg_type])
+            route = _WebServerRoute(url_path, method.upper(), func, route_arg_names, route_arg_converters, options)
+            if options and options.get('event_stream', False):
+                replay_size = options.get('replay_size', None)
+                self._event_channels[url_path] = _EventChannel(self.event_stream_replay_size if replay_size is None else replay_size)
+
+            if route_arg_names:
+                node = self._route_tree
+                arg_index = 0
+                for s in route_parts:
+                    if s.startswith('<') and s.endswith('>'):
+                        node = self._add_route_param_node(node, route_arg_types[arg_index], route_arg_converters[arg_index])
+                        arg_index += 1
+                    else:
+                        child = node.children.get(s, None)
+                        if child is None:
+                            child = _WebServerRouteNode()
+                            node.children[s] = child
+                        node = child
+                if node.routes is None:
+                    node.routes = { }
+                routes = node.routes
+            else:
+                routes = self._static_routes.setdefault(''.join('/' + s for s in route_parts), { })
+            ## 同じパスとメソッドが重複した場合は先に登録されたものを優先する.
+            if route.method not in routes:
+                routes[route.method] = route
+            TMiniWebServer.dlog('route add: %s, %s', url_path, route_arg_names)
+
+    @staticmethod
+    def _add_route_param_node(node, arg_type, converter):
+        for param_type, _, child in node.params:
+            if param_type == arg_type:
+                return child
+        child = _WebServerRouteNode()
+        ## 同じ位置に複数の型があるときは int, hex, str, path の順に試す.
+        order = TMiniWebServer._route_converter_order
+        index = 0
+        while index < len(node.params) and order.index(node.params[index][0]) < order.index(arg_type):
+            index += 1
+        node.params.insert(index, (arg_type, converter, child))
+        return child
 
     async def start(self):
         if self.is_started():
             return
-        server = await asyncio.start_server(self._server_proc, host=self._server_ip, port=self._server_port, backlog = 5)
+        server = await asyncio.start_server(self._server_proc, host=self._server_ip, port=self._server_port, backlog = self.backlog)
         self._server = server
         self._running = True
-        TMiniWebServer.log(f'start server on {self._server_ip}:{self._server_port}')
+        if self.log_file:
+            TMiniWebServer.logger.start_flush_task(self.log_file, self.log_flush_interval)
+        TMiniWebServer.log('start server on %s:%s', self._server_ip, self._server_port)
 
     def stop(self):
         if not self.is_started():
@@ -92,52 +638,201 @@ class TMiniWebServer:
     def is_started(self):
         return self._running
 
-    def _get_route_handler(self, url_path, method):
-        TMiniWebServer.dlog(f'search {url_path},{method}')
-        try:
-            if self._route_handlers:
-                if url_path.endswith('/'):
-                    url_path = url_path[:-1]
-                method = method.upper()
-                for handler in self._route_handlers:
-                    if handler.method == method:
-                        m = handler.route_regex.match(url_path)
-                        if m:
-                            if handler.route_arg_names:
-                                route_args = { }
-                                for i, name in enumerate(handler.route_arg_names):
-                                    value = m.group(i+1)
-                                    try:
-                                        value = int(value)
-                                    except:
-                                        pass
-                                    route_args[name] = value
-                                return (handler.func, route_args)
-                            else:
-                                return (handler.func, None)
-        except Exception as ex:
-            sys.print_exception(ex)
-            print(f"  {url_path}, {method}")
+    async def _write_log(self, client):
+        await client.write_response('\n'.join(TMiniWebServer.logger.get_lines()), content_type='text/plain')
+
+    async def _write_metrics(self, client):
+        if client._query_params.get('format', None) == 'json' or 'application/json' in client._headers.get('accept', ''):
+            await client.write_response(self.metrics.to_json(), content_type='application/json')
+        else:
+            await client.write_response(self.metrics.to_prometheus(), content_type='text/plain; version=0.0.4')
+
+    def invalidate_response_cache(self, url_path = None):
+        ## url_path(リクエストのパス)の応答のキャッシュを捨てる. 省略するとすべて捨てる.
+        if self.response_cache is not None:
+            self.response_cache.invalidate(url_path)
 
+    def publish_event(self, url_path, data, event = None, id = None):
+        ## event_stream のパス(デコレーターに指定したもの)の全クライアントへイベントを送る.
+        ## 送信を予約したクライアントの数を返す.
+        channel = self._event_channels.get(url_path, None)
+        if channel is None:
+            TMiniWebServer.elog('event stream is not found. [%s]', url_path)
+            return 0
+        return channel.publish(data, event, id, self.event_stream_queue_size)
+
+    def _get_route_handler(self, url_path, method):
+        TMiniWebServer.dlog('search %s,%s', url_path, method)
+        route, values, _ = self._match_route(url_path, method.upper())
+        if route:
+            return (route.func, self._get_route_args(route, values))
         return (None, None)
 
+    def _match_route(self, url_path, method):
+        ## パスとメソッドに一致したルートと、パラメーターの値のリストを返す.
+        ## パスに一致してもメソッドが違うルートは飛ばして次の候補を探し、
+        ## 見つからなければ候補にあったメソッドの一覧を3つ目に返す.
+        if url_path.endswith('/'):
+            url_path = url_path[:-1]
+        allowed = [ ]
+        routes = self._static_routes.get(url_path, None)
+        if routes is not None:
+            route = routes.get(method, None)
+            if route is not None:
+                return route, None, None
+            allowed.extend(routes)
+        if url_path.startswith('/'):
+            values = [ ]
+            route = self._match_route_node(self._route_tree, url_path.split('/'), 1, values, method, allowed)
+            if route is not None:
+                return route, values, None
+        return None, None, allowed
+
+    def _match_route_node(self, node, segments, index, values, method, allowed):
+        if index == len(segments):
+            if node.routes:
+                route = node.routes.get(method, None)
+                if route is not None:
+                    return route
+                for m in node.routes:
+                    if m not in allowed:
+                        allowed.append(m)
+            return None
+        segment = segments[index]
+        ## 固定セグメントを優先し、一致しなければパラメーターとして試す.
+        child = node.children.get(segment, None)
+        if child is not None:
+            found = self._match_route_node(child, segments, index + 1, values, method, allowed)
+            if found is not None:
+                return found
+        for param_type, converter, param_node in node.params:
+            if param_type == 'path':
+                ## path は '/' を含めて複数のセグメントを取り込む.
+                ## 後ろに固定セグメントが続くルートを優先するため短い順に試す.
+                end = index + 1
+                while end <= len(segments):
+                    value = '/'.join(segments[index:end])
+                    if value:
+                        values.append(value)
+                        found = self._match_route_node(param_node, segments, end, values, method, allowed)
+                        if found is not None:
+                            return found
+                        values.pop()
+                    end += 1
+                continue
+            value = converter(segment)
+            if value is not None:
+                values.append(value)
+                found = self._match_route_node(param_node, segments, index + 1, values, method, allowed)
+                if found is not None:
+                    return found
+                values.pop()
+        return None
+
+    def _get_route_args(self, route, values):
+        ## values は探索時に各型へ変換済み.
+        if not route.route_arg_names:
+            return None
+        route_args = { }
+        for i, name in enumerate(route.route_arg_names):
+            route_args[name] = values[i]
+        return route_args
+
+    def _is_memory_low(self):
+        if not self.min_free_memory or not hasattr(gc, 'mem_free'):
+            return False
+        if gc.mem_free() >= self.min_free_memory:
+            return False
+        gc.collect()
+        return gc.mem_free() < self.min_free_memory
+
+    async def _wait_connection_slot(self):
+        while self._connection_count >= self.max_connections:
+            self._connection_released.clear()
+            await self._connection_released.wait()
+
+    async def _acquire_connection(self):
+        ## 接続数の上限に達していれば空きを待つ. 待ちきれなければ False.
+        if self.max_connections and self._connection_count >= self.max_connections:
+            if not self.connection_wait_timeout:
+                return False
+            self._connection_waiters += 1
+            try:
+                await asyncio.wait_for(self._wait_connection_slot(), self.connection_wait_timeout)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                self._connection_waiters -= 1
+        self._connection_count += 1
+        return True
+
+    def _release_connection(self):
+        self._connection_count -= 1
+        self._connection_released.set()
+
+    async def _reject_connection(self, writer):
+        try:
+            writer.write(self._busy_response)
+            await writer.drain()
+        except:
+            pass
+
     async def _server_proc(self, reader, writer):
         addr = ''
+        acquired = False
+        metrics = self.metrics
         try:
             addr = writer.get_extra_info('peername')
-            TMiniWebServer.log(f"connected by {addr}")
-            client = TMiniWebClient(reader, writer, self)
-            if not await client._processRequest():
-                TMiniWebServer.log(f'process request failed. {addr}')
+            TMiniWebServer.log("connected by %s", addr)
+            if metrics is not None:
+                metrics.connections_total += 1
+            if self._is_memory_low():
+                TMiniWebServer.elog("low memory, rejected %s", addr)
+                await self._reject_connection(writer)
+            else:
+                acquired = await self._acquire_connection()
+                if not acquired:
+                    TMiniWebServer.elog("too many connections, rejected %s", addr)
+                    await self._reject_connection(writer)
+            if acquired:
+                if metrics is not None:
+                    reader = _MetricsStream(reader, metrics)
+                    writer = _MetricsStream(writer, metrics)
+                await self._process_connection(reader, writer, addr)
+            elif metrics is not None:
+                metrics.connections_rejected += 1
         except Exception as e:
-            TMiniWebServer.log(e)
+            TMiniWebServer.elog('%s', e)
 
         try:
             writer.close()
             await writer.wait_closed()
         except:
             pass
-        TMiniWebServer.dlog(f"webclient is terminated. [{addr}]")
+        TMiniWebServer.dlog("webclient is terminated. [%s]", addr)
+
+    async def _process_connection(self, reader, writer, addr):
+        ## Keep-Alive の間は同じ接続で次のリクエストを処理する.
+        ## パイプライン化されたリクエストは読み過ぎた分として reader に残り、順に読み出される.
+        ## 接続数の枠はここで返す. WebSocket などに切り替わった接続はその時点で返している.
+        client = None
+        try:
+            reader = _ConnectionReader(reader, self.max_request_line + self.max_header_size)
+            request_count = 0
+            while True:
+                request_count += 1
+                client = TMiniWebClient(reader, writer, self, request_count)
+                if not await client._processRequest():
+                    TMiniWebServer.elog('process request failed. %s', addr)
+                    break
+                if not client._keep_alive:
+                    break
+                if self._connection_waiters:
+                    ## 空きを待っている接続があれば、持続的接続を切って譲る.
+                    break
+        finally:
+            if client is None or not client._connection_released:
+                self._release_connection()
 
     def get_phys_path_in_wwwroot(self, request_path):
         file_path = ''
@@ -156,6 +851,85 @@ class TMiniWebServer:
         mime_type = TMiniWebServerUtil.get_minetype_from_ext(file_path)
         return file_path, mime_type
 
+    def _get_static_file(self, request_path):
+        cache = self.static_cache
+        if cache is not None:
+            entry = cache.get(request_path)
+            if entry is not None:
+                return entry
+        entry = self._load_static_file(request_path)
+        if entry is not None and cache is not None:
+            cache.put(request_path, entry)
+        return entry
+
+    def _load_static_file(self, request_path):
+        ## get_phys_path_in_wwwroot と同じ探索を stat 1回で行い、サイズもここで確定させる.
+        if request_path != '/':
+            file_names = (request_path,)
+        else:
+            file_names = ('index.html', 'index.htm')
+        for file_name in file_names:
+            file_path = self._wwwroot + '/' + file_name
+            file_stat = TMiniWebServerUtil.get_file_stat(file_path)
+            if file_stat is not None:
+                break
+        else:
+            return None
+        if file_stat[0] & 0x4000:   ## ディレクトリ
+            return None
+        mime_type = TMiniWebServerUtil.get_minetype_from_ext(file_path)
+        cache_control = self._get_cache_control(request_path, file_path)
+        entry = self._create_static_file_entry(file_path, file_stat, mime_type, cache_control)
+
+        if self.static_gzip:
+            gzip_path = file_path + '.gz'
+            gzip_stat = TMiniWebServerUtil.get_file_stat(gzip_path)
+            if gzip_stat is not None and not (gzip_stat[0] & 0x4000):
+                ## 圧縮済みファイルは元のファイルの MIME タイプで content-encoding を付けて送る.
+                gzip_entry = self._create_static_file_entry(gzip_path, gzip_stat, mime_type, cache_control)
+                gzip_entry.headers['content-encoding'] = 'gzip'
+                gzip_entry.headers['vary'] = 'Accept-Encoding'
+                entry.headers['vary'] = 'Accept-Encoding'
+                entry.gzip = gzip_entry
+        return entry
+
+    def _create_static_file_entry(self, file_path, file_stat, mime_type, cache_control):
+        size = file_stat[6]
+        data = None
+        cache = self.static_cache
+        if cache is not None and size <= cache.max_file_size:
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            size = len(data)
+
+        mtime = file_stat[8]
+        headers = { 'etag': f'"{size:x}-{mtime:x}"', 'accept-ranges': 'bytes' }
+        if mtime > 0:
+            headers['last-modified'] = TMiniWebServerUtil.format_http_date(mtime)
+        if cache_control:
+            headers['cache-control'] = cache_control
+        return _StaticFileEntry(file_path, mime_type, size, data, headers)
+
+    def _get_cache_control(self, request_path, file_path):
+        cache_control = self.cache_control
+        if cache_control:
+            for key in cache_control:
+                if key.endswith('/') and request_path.startswith(key):
+                    return cache_control[key]
+            file_path = file_path.lower()
+            for key in cache_control:
+                if key.startswith('.') and file_path.endswith(key):
+                    return cache_control[key]
+        return self.cache_control_default
+
+    _route_converters = {
+        'int': _convert_route_int,
+        'hex': _convert_route_hex,
+        'str': _convert_route_str,
+        'path': _convert_route_str,
+    }
+    _route_converter_order = ('int', 'hex', 'str', 'path')
+
     _http_status_messages = {
         HttpStatusCode.SWITCH_PROTOCOLS: 'Switching Protocols',
         HttpStatusCode.OK: 'OK',
@@ -190,6 +964,7 @@ class TMiniWebServer:
         HttpStatusCode.UNSUPPORTED_MEDIA_TYPE: 'Unsupported Media Type',
         HttpStatusCode.REQUESTED_RANGE_NOT_SATISFIABLE: 'Requested Range Not Satisfiable',
         HttpStatusCode.EXPECTATION_FAILED: 'Expectation Failed',
+        HttpStatusCode.REQUEST_HEADER_FIELDS_TOO_LARGE: 'Request Header Fields Too Large',
         HttpStatusCode.INTERNAL_SERVER_ERROR: 'Internal Server Error',
         HttpStatusCode.NOT_IMPLEMENTED: 'Not Implemented',
         HttpStatusCode.BAD_GATEWAY: 'Bad Gateway',
@@ -197,24 +972,53 @@ class TMiniWebServer:
         HttpStatusCode.GATEWAY_TIMEOUT: 'Gateway Timeout',
         HttpStatusCode.HTTP_VERSION_NOT_SUPPORTED: 'HTTP Version Not Supported',
     }
+    ## ステータス行は起動時に bytes にしておき、応答毎に組み立てない.
+    _http_status_lines = { code: f'HTTP/1.1 {code} {msg}\r\n'.encode() for code, msg in _http_status_messages.items() }
 
 
 
 class TMiniWebClient:
-    def __init__(self, reader, writer, server):
+    _server_header = b'server: TMiniWebServer\r\n'
+    _connection_headers = (b'connection: close\r\n', b'connection: keep-alive\r\n')
+
+    def __init__(self, reader, writer, server, request_count = 1):
         self._reader = reader
         self._writer = writer
         self._server = server
+        self._request_count = request_count
         self._method = None
         self._req_path = '/'
         self._path = None
+        self._http_ver = None
         self._headers = { }
         self._content_type = None
         self._content_length = 0
+        self._content_remain = 0    ## chunked の場合は現在のチャンクの残り.
+        self._content_received = 0
+        self._request_chunked = False
+        self._request_content_ended = False
+        self._request_content_too_large = False
+        self._expect_continue = False
         self._query_string = ""
-        self._query_params = { }
+        self._query_params = TMiniWebQueryParams(None)
+        self._form_params = None
+        self._keep_alive = False
+        self._parse_error = None
+        self._request_content_timed_out = False
+        self._request_content_invalid = False   ## chunked の区切りが壊れていた
+        self._response_capture = None   ## キャッシュするルートで write_response の内容を受け取る
+        self._extra_headers = None      ## add_response_header で追加されたヘッダ
+        self._route_key = None          ## メトリクスの集計に使うルートのパターン
+        self._status_code = None
+        self._head = None
+        self._head_start = 0
+        self._response_started = False
+        self._response_header = None
+        self._response_stream = None
+        self._connection_released = False   ## 接続数の枠を返した
 
     async def close(self):
+        self._keep_alive = False
         self._writer.close()
         await self._writer.wait_closed()
 
@@ -229,15 +1033,55 @@ class TMiniWebClient:
                 content_length = 0
             self._write_status_code(http_status)
             self._write_headers(headers, content_type, content_charset, content_length)
-            await self._writer.drain()
-
-            self._writer.write(content)
+            if self._response_capture is not None and http_status == HttpStatusCode.OK:
+                self._capture_response(content)
+            self._send_response_header(content)
             await self._writer.drain()
         except Exception as ex:
-            TMiniWebServer.log(ex)
+            TMiniWebServer.elog('%s', ex)
             pass
         TMiniWebServer.dlog('[out] write_response')
 
+    def add_response_header(self, name, value):
+        ## このリクエストの応答に付けるヘッダを追加する. ミドルウェアで CORS などのヘッダを付けるのに使う.
+        if self._extra_headers is None:
+            self._extra_headers = bytearray()
+        self._extra_headers.extend(f"{name}: {value}\r\n".encode())
+
+    def _capture_response(self, content):
+        ## connection ヘッダと add_response_header のヘッダはリクエスト毎に変わるので、
+        ## その前後に分けて保持する.
+        header = bytes(self._response_header)
+        connection = TMiniWebClient._connection_headers[1 if self._keep_alive else 0]
+        index = header.find(connection)
+        if index < 0:
+            return
+        end = index + len(connection) + (len(self._extra_headers) if self._extra_headers else 0)
+        self._response_capture.append((header[:index], header[end:], bytes(content) if content else b''))
+
+    async def _write_cached_response(self, entry):
+        self._response_started = True
+        self._status_code = HttpStatusCode.OK
+        data = bytearray(entry.head)
+        data.extend(TMiniWebClient._connection_headers[1 if self._keep_alive else 0])
+        if self._extra_headers:
+            data.extend(self._extra_headers)
+        data.extend(entry.tail)
+        content = entry.content
+        if len(content) <= self._server.response_coalesce_size:
+            data.extend(content)
+            content = None
+        self._writer.write(data)
+        if content:
+            self._writer.write(content)
+        await self._writer.drain()
+
+    def _get_response_cache_key(self, options):
+        key = f'{self._method} {self._req_path}'
+        for name in options.get('cache_query', ()):
+            key += f'&{name}={self._query_params.get(name, "")}'
+        return key
+
     async def write_response_from_file(self, file_phys_path, headers={}, http_status = HttpStatusCode.OK, content_type=None, content_charset='UTF-8'):
         TMiniWebServer.dlog('[in] write_response_from_file')
         try:
@@ -248,75 +1092,375 @@ class TMiniWebClient:
                 content_type = TMiniWebServerUtil.get_minetype_from_ext(file_phys_path)
 
             content_length = TMiniWebServerUtil.get_file_size(file_phys_path)
+            await self._send_file(file_phys_path, headers, http_status, content_type, content_charset, content_length)
+        except Exception as ex:
+            sys.print_exception(ex)
+
+        TMiniWebServer.dlog('[out] write_response_from_file')
+
+    async def _send_file(self, file_phys_path, headers, http_status, content_type, content_charset, content_length, offset = 0):
+        try:
             self._write_status_code(http_status)
             self._write_headers(headers, content_type, content_charset, content_length)
-            await self._writer.drain()
+            self._send_response_header()
             
             if content_length > 0:
-                with open(file_phys_path, 'rb') as f:
-                    while True:
-                        data = f.read(4*1024)
-                        if len(data) > 0:
-                            self._writer.write(data)
+                buffer_pool = self._server._file_buffers
+                buffer = await buffer_pool.acquire()
+                try:
+                    ## 確保済みのバッファへ readinto で読み込み、チャンク毎のメモリ確保をなくす.
+                    view = memoryview(buffer)
+                    with open(file_phys_path, 'rb') as f:
+                        if offset > 0:
+                            f.seek(offset)
+                        remain = content_length
+                        while remain > 0:
+                            if remain < len(buffer):
+                                read_size = f.readinto(view[:remain])
+                            else:
+                                read_size = f.readinto(buffer)
+                            if not read_size:
+                                break
+                            self._writer.write(buffer if read_size == len(buffer) else view[:read_size])
                             await self._writer.drain()
-                        else:
-                            break
+                            remain -= read_size
+                finally:
+                    buffer_pool.release(buffer)
+        except:
+            ## 途中まで送ったレスポンスは終端が分からないので接続を閉じる.
+            self._keep_alive = False
+            raise
+        finally:
             if TMiniWebServer.gc_after_filesend:
                 gc.collect()
-        except Exception as ex:
-            sys.print_exception(ex)
 
-        TMiniWebServer.dlog('[out] write_response_from_file')
+    async def _write_static_file(self, entry):
+        if self._is_not_modified(entry):
+            TMiniWebServer.dlog('not modified [%s]', entry.file_path)
+            try:
+                self._write_status_code(HttpStatusCode.NOT_MODIFIED)
+                self._write_headers(entry.headers, None, None, None)
+                self._send_response_header()
+                await self._writer.drain()
+            except Exception as ex:
+                TMiniWebServer.elog('%s', ex)
+            return
+
+        byte_range = None
+        range_header = self._headers.get('range', None)
+        if range_header is not None and self._is_range_fresh(entry):
+            byte_range = TMiniWebServerUtil.parse_byte_range(range_header, entry.size)
+            if byte_range is False:
+                TMiniWebServer.dlog('range not satisfiable [%s, %s]', range_header, entry.size)
+                await self.write_response(TMiniWebServer._http_status_messages[HttpStatusCode.REQUESTED_RANGE_NOT_SATISFIABLE],
+                                          headers={ 'content-range': f'bytes */{entry.size}' },
+                                          http_status=HttpStatusCode.REQUESTED_RANGE_NOT_SATISFIABLE)
+                return
+
+        if byte_range is None:
+            http_status = HttpStatusCode.OK
+            headers = entry.headers
+            offset = 0
+            length = entry.size
+        else:
+            http_status = HttpStatusCode.PARTIAL_CONTENT
+            offset, last = byte_range
+            length = last - offset + 1
+            headers = dict(entry.headers)
+            headers['content-range'] = f'bytes {offset}-{last}/{entry.size}'
+
+        if entry.data is not None:
+            data = entry.data
+            if byte_range is not None:
+                data = memoryview(data)[offset:offset + length]
+            await self.write_response(data, headers=headers, http_status=http_status, content_type=entry.mime_type)
+        else:
+            try:
+                await self._send_file(entry.file_path, headers, http_status, entry.mime_type, 'UTF-8', length, offset)
+            except Exception as ex:
+                sys.print_exception(ex)
+
+    def _is_range_fresh(self, entry):
+        ## If-Range が現在の etag / last-modified と一致しないときは Range を無視して全体を送る.
+        if_range = self._headers.get('if-range', None)
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        return if_range == entry.headers['etag'] or if_range == entry.headers.get('last-modified', None)
+
+    def _accepts_encoding(self, encoding):
+        ## Accept-Encoding をトークンに分けて判定する. 'gzip;q=0' は拒否の意味になる.
+        accepted = None
+        for token in self._headers.get('accept-encoding', '').lower().split(','):
+            params = token.split(';')
+            name = params[0].strip()
+            if name != encoding and name != '*':
+                continue
+            quality = 1
+            for param in params[1:]:
+                param = param.strip()
+                if param.startswith('q='):
+                    try:
+                        quality = float(param[2:])
+                    except ValueError:
+                        quality = 0
+            if name == encoding:
+                ## 名前での指定は '*' より優先する.
+                return quality > 0
+            accepted = quality > 0
+        return bool(accepted)
+
+    def _is_not_modified(self, entry):
+        ## If-None-Match を優先し、無いときだけ If-Modified-Since を見る.
+        ## 日付はこちらが送った last-modified がそのまま返される前提で文字列として比較する.
+        if_none_match = self._headers.get('if-none-match', None)
+        if if_none_match is not None:
+            return if_none_match.strip() == '*' or entry.headers['etag'] in if_none_match
+        if_modified_since = self._headers.get('if-modified-since', None)
+        if if_modified_since is not None:
+            return if_modified_since.strip() == entry.headers.get('last-modified', None)
+        return False
+
+    async def start_stream(self, headers={}, http_status = HttpStatusCode.OK, content_type="text/html", content_charset='UTF-8'):
+        ## ボディの長さを決めずに応答を開始する. HTTP/1.1 では chunked で送り、
+        ## HTTP/1.0 では接続を閉じてボディの終端を知らせる.
+        TMiniWebServer.dlog('[in] start_stream')
+        chunked = self._http_ver == 'HTTP/1.1'
+        if not chunked:
+            self._keep_alive = False
+        self._write_status_code(http_status)
+        self._write_content_type_header(content_type, content_charset)
+        if chunked:
+            self._write_header('transfer-encoding', 'chunked')
+        self._write_headers(headers, None, None, None)
+        self._send_response_header()
+        self._response_stream = TMiniWebResponseStream(self, chunked, content_charset)
+        return self._response_stream
+
+    async def write_response_stream(self, source, headers={}, http_status = HttpStatusCode.OK, content_type="text/html", content_charset='UTF-8'):
+        ## source はイテレーター(ジェネレーター)か、__aiter__ を持つ非同期イテレーター.
+        try:
+            stream = await self.start_stream(headers, http_status, content_type, content_charset)
+            if hasattr(source, '__aiter__'):
+                async for data in source:
+                    await stream.write(data)
+            else:
+                for data in source:
+                    await stream.write(data)
+            await stream.end()
+        except Exception as ex:
+            self._keep_alive = False
+            TMiniWebServer.elog('%s', ex)
 
     async def write_error_response(self, code, content=None):
         if content is None:
             content = TMiniWebServer._http_status_messages.get(code, '')
-        TMiniWebServer.dlog(content)
+        TMiniWebServer.dlog('%s', content)
         await self.write_response(http_status=code, content=content)
 
     async def read_request_content(self):
+        ## ボディ全体を1つの bytearray に読み込む. 大きなボディは iter_request_content や
+        ## save_request_content で少しずつ処理すること.
         try:
-            data = await self._reader.read(self._content_length)
-            return data
-        except:
-            pass
+            if not self._request_chunked:
+                data = bytearray(self._content_remain)
+                view = memoryview(data)
+                offset = 0
+                while offset < len(data):
+                    offset += await self.read_request_content_into(view[offset:])
+                return data
+            data = bytearray()
+            while True:
+                chunk = await self.read_request_content_chunk()
+                if not chunk:
+                    return data
+                data.extend(chunk)
+        except Exception as ex:
+            if self._has_request_content_error():
+                raise
+            TMiniWebServer.dlog('read_request_content: %s', ex)
         return b''
+
+    async def read_request_content_chunk(self, size = 512):
+        ## ボディの続きを最大 size バイト返す. 終端に達すると b''.
+        if not await self._prepare_request_content():
+            return b''
+        data = await self._wait_request_content(self._reader.read(min(size, self._content_remain)))
+        await self._consume_request_content(len(data))
+        return data
+
+    async def read_request_content_into(self, buffer):
+        ## ボディの続きを buffer に読み込み、読み込んだバイト数を返す. 終端に達すると 0.
+        if not await self._prepare_request_content():
+            return 0
+        if len(buffer) > self._content_remain:
+            buffer = memoryview(buffer)[:self._content_remain]
+        read_size = await self._wait_request_content(self._reader.readinto(buffer))
+        await self._consume_request_content(read_size)
+        return read_size
+
+    def iter_request_content(self, chunk_size = 512):
+        ## async for で使えるボディのイテレーター.
+        return _RequestContentIterator(self, chunk_size)
+
+    async def save_request_content(self, file_path):
+        ## ボディをメモリに溜めずにファイルへ書き込み、書き込んだバイト数を返す.
+        buffer_pool = self._server._file_buffers
+        buffer = await buffer_pool.acquire()
+        total = 0
+        try:
+            view = memoryview(buffer)
+            with open(file_path, 'wb') as f:
+                while True:
+                    read_size = await self.read_request_content_into(buffer)
+                    if not read_size:
+                        break
+                    f.write(buffer if read_size == len(buffer) else view[:read_size])
+                    total += read_size
+        finally:
+            buffer_pool.release(buffer)
+        return total
+
+    async def _prepare_request_content(self):
+        if self._expect_continue:
+            ## ハンドラーがボディを読み始めたときに初めて送信を促す.
+            self._expect_continue = False
+            self._writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            await self._writer.drain()
+        if self._content_remain == 0 and self._request_chunked and not self._request_content_ended:
+            await self._read_request_chunk_size()
+        return self._content_remain > 0
+
+    async def _read_request_chunk_size(self):
+        line = await self._wait_request_content(self._reader.readline())
+        if not line:
+            raise EOFError('request content is truncated')
+        size = line.split(b';', 1)[0].strip()
+        if not size or size.strip(b'0123456789abcdefABCDEF'):
+            ## 負の値などを許すと、ボディの続きを次のリクエストとして扱ってしまう.
+            self._invalid_request_content()
+        size = int(size, 16)
+        if size == 0:
+            ## 最後のチャンク. トレーラーは読み捨てる.
+            self._request_content_ended = True
+            while True:
+                line = await self._wait_request_content(self._reader.readline())
+                if not line or line == b'\r\n' or line == b'\n':
+                    break
+        self._content_remain = size
+
+    async def _consume_request_content(self, read_size):
+        if not read_size:
+            self._keep_alive = False
+            raise EOFError('request content is truncated')
+        self._content_remain -= read_size
+        self._content_received += read_size
+        max_size = self._server.max_request_body_size
+        if max_size and self._content_received > max_size:
+            self._request_content_too_large = True
+            self._keep_alive = False
+            raise ValueError('request content is too large')
+        if self._request_chunked and self._content_remain == 0:
+            if await self._wait_request_content(self._reader.readexactly(2)) != b'\r\n':   ## チャンク末尾の CRLF
+                self._invalid_request_content()
+
+    def _has_request_content_error(self):
+        ## 上限を超えたことや時間切れ、壊れた chunked はハンドラーの外へ伝えて 413/408/400 を返す.
+        return self._request_content_too_large or self._request_content_timed_out or self._request_content_invalid
+
+    def _invalid_request_content(self):
+        self._request_content_invalid = True
+        self._keep_alive = False
+        raise ValueError('invalid chunked request content')
+
+    async def _wait_request_content(self, coro):
+        try:
+            return await _wait(coro, self._server.request_body_timeout)
+        except asyncio.TimeoutError:
+            self._request_content_timed_out = True
+            self._keep_alive = False
+            raise
+
+    async def _discard_request_content(self):
+        ## ハンドラーが読まなかったボディを読み捨てて、次のリクエストの先頭に合わせる.
+        if self._expect_continue:
+            ## 100 Continue を送っていないので、クライアントはボディを送ってこない可能性がある.
+            self._keep_alive = False
+            return
+        while self._keep_alive and await self.read_request_content_chunk():
+            pass
     
     async def read_request_json_content(self):
         try:
             data = await self.read_request_content()
             return loads(data.decode())
         except:
-            pass
+            if self._has_request_content_error():
+                raise
         return None
     
     async def get_www_form_urlencoded(self):
-        result = { }
+        ## ボディは一度しか読めないので、結果は保持して 2回目以降はそれを返す.
+        if self._form_params is not None:
+            return self._form_params
+        result = TMiniWebQueryParams(None, True)
         try:
             if self._content_type:
                 params = self._content_type.lower().split(';')
                 if params[0].strip() == 'application/x-www-form-urlencoded':
                     data = await self.read_request_content()
                     if data:
-                        elements = data.decode().split('&')
-                        for s in elements:
-                            param = s.split('=', 1)
-                            if len(param) > 0:
-                                value = TMiniWebServerUtil.unquote_plus(param[1]) if len(param) > 1 else ''
-                                result[TMiniWebServerUtil.unquote_plus(param[0])] = value
+                        result = TMiniWebQueryParams(data.decode(), True)
         except:
-            pass
-        TMiniWebServer.dlog(f'www-form-urlencoded: {result}')
+            if self._has_request_content_error():
+                raise
+        self._form_params = result
+        TMiniWebServer.dlog('www-form-urlencoded: %s', result)
         return result
 
+    def get_multipart_form(self, chunk_size = 512):
+        ## multipart/form-data のボディを読むための TMiniWebMultipartReader を返す.
+        ## 他の形式のときは None.
+        if not self._content_type:
+            return None
+        params = self._content_type.split(';')
+        if params[0].strip().lower() != 'multipart/form-data':
+            return None
+        for param in params[1:]:
+            elements = param.split('=', 1)
+            if len(elements) == 2 and elements[0].strip().lower() == 'boundary':
+                boundary = elements[1].strip()
+                if len(boundary) >= 2 and boundary[0] == '"' and boundary[-1] == '"':
+                    boundary = boundary[1:-1]
+                return TMiniWebMultipartReader(self, boundary, chunk_size)
+        return None
+
 
+    ## 応答ヘッダは _response_header に溜めておき、_send_response_header でまとめて書き込む.
     def _write_status_code(self, status_code):
-        msg = TMiniWebServer._http_status_messages.get(status_code, '')
-        data = f"HTTP/1.1 {status_code} {msg}\r\n"
-        self._writer.write(data)
+        data = TMiniWebServer._http_status_lines.get(status_code, None)
+        if data is None:
+            data = f"HTTP/1.1 {status_code} \r\n".encode()
+        self._response_started = True
+        self._status_code = status_code
+        self._response_header = bytearray(data)
     
     def _write_header(self, name, value):
-        self._writer.write(f"{name}: {value}\r\n")
+        self._response_header.extend(f"{name}: {value}\r\n".encode())
+
+    def _end_headers(self):
+        self._response_header.extend(b"\r\n")
+
+    def _send_response_header(self, content=None):
+        ## 小さなボディはヘッダと同じバッファに入れて、1回の書き込みで送る.
+        data = self._response_header
+        self._response_header = None
+        if content and len(content) <= self._server.response_coalesce_size:
+            data.extend(content)
+            content = None
+        self._writer.write(data)
+        if content:
+            self._writer.write(content)
 
     def _write_content_type_header(self, content_type, charset = None):
         ct = "application/octet-stream"
@@ -328,36 +1472,74 @@ class TMiniWebClient:
         if isinstance(headers, dict):
             for header in headers:
                 self._write_header(header, headers[header])
-        self._write_header("server", "TMiniWebServer")
-        self._write_header("connection", "close")
-        if content_length > 0:
-            self._write_content_type_header(content_type, content_charset)
+        self._response_header.extend(TMiniWebClient._server_header)
+        self._response_header.extend(TMiniWebClient._connection_headers[1 if self._keep_alive else 0])
+        if self._extra_headers:
+            self._response_header.extend(self._extra_headers)
+        ## content_length が None のときはボディを持たない応答(304 など)として長さを送らない.
+        if content_length is not None:
+            if content_length > 0:
+                self._write_content_type_header(content_type, content_charset)
+            ## Keep-Alive ではボディの終端を示すため、0 でも content-length を送る.
             self._write_header('content-length', content_length)
-        self._writer.write("\r\n")
+        self._end_headers()
 
     async def _processRequest(self):
-        if await self._parse():
-            if await self._parse_header():
+        parsed = await self._parse()
+        if parsed is None:
+            ## リクエストが来る前に接続が閉じられた(Keep-Alive の待機終了を含む).
+            return True
+        if parsed:
+            if self._parse_header():
+                max_size = self._server.max_request_body_size
+                if max_size and self._content_length > max_size:
+                    ## 100 Continue を待っているクライアントにはボディを送らせずに断る.
+                    self._keep_alive = False
+                    await self.write_error_response(HttpStatusCode.REQUEST_ENTITY_TOO_LARGE)
+                    return True
                 is_upg = self._check_upgrade()
                 if not is_upg:
-                    return await self._routing_http()
+                    if self._server.metrics is not None:
+                        return await self._routing_http_with_metrics()
+                    if not self._server._use_middleware:
+                        return await self._routing_http()
+                    return await self._routing_http_with_middleware()
                 else:
                     ## WebSocket
                     if is_upg == 'websocket':
                         return await self._routing_websocket()
                     else:
+                        self._keep_alive = False
                         await self._write_bad_request()
             else:
-                await self._write_bad_request()
+                await self.write_error_response(self._parse_error or HttpStatusCode.BAD_REQUEST)
         else:
-            await self._write_internal_server_error()
+            await self.write_error_response(self._parse_error or HttpStatusCode.INTERNAL_SERVER_ERROR)
         return False
 
     async def _parse(self):
         try:
-            readline = await self._reader.readline()
-            line = readline.decode().strip()
-            elements = line.split()
+            server = self._server
+            idle_timeout = server.keep_alive_timeout if self._request_count > 1 else server.request_head_timeout
+            try:
+                head, complete = await self._reader.read_head(idle_timeout, server.request_head_timeout)
+            except asyncio.TimeoutError:
+                TMiniWebServer.elog('request head timeout')
+                self._parse_error = HttpStatusCode.REQUEST_TIMEOUT
+                return False
+            if head is None:
+                return None
+            line_end = head.find(b'\r\n')
+            if line_end < 0 or line_end > self._server.max_request_line:
+                ## リクエスト行が長すぎるか、バッファに収まらなかった.
+                self._parse_error = HttpStatusCode.REQUEST_URI_TOO_LONG
+                return False
+            if not complete:
+                self._parse_error = HttpStatusCode.REQUEST_HEADER_FIELDS_TOO_LARGE
+                return False
+            self._head = head
+            self._head_start = line_end + 2
+            elements = head[:line_end].decode().split()
             if len(elements) == 3:
                 self._method = elements[0].upper()
                 self._path = elements[1]
@@ -367,46 +1549,75 @@ class TMiniWebClient:
                 if len(elements) > 0:
                     self._req_path = TMiniWebServerUtil.unquote_plus(elements[0]) 
                     if len(elements) > 1:
+                        ## パラメーターはハンドラーが参照したときに解析する.
                         self._query_string = elements[1]
-                        elements = self._query_string.split('&')
-                        for s in elements:
-                            param = s.split('=', 1)
-                            if len(param) > 0:
-                                value = TMiniWebServerUtil.unquote(param[1]) if len(param) > 1 else ''
-                                self._query_params[TMiniWebServerUtil.unquote(param[0])] = value
-                        TMiniWebServer.dlog(f'{self} query_string:{self._query_string}')
-                        TMiniWebServer.dlog(f'{self} query_params:{self._query_params}')
+                        self._query_params = TMiniWebQueryParams(self._query_string)
+                        TMiniWebServer.dlog('%s query_string:%s', self._req_path, self._query_string)
                 return True
             else:
                 TMiniWebServer.dlog("failed read first line (httprequest)")
+                self._parse_error = HttpStatusCode.BAD_REQUEST
                 return False
 
             return True
         except Exception as ex:
-            TMiniWebServer.log(ex)
+            TMiniWebServer.elog('%s', ex)
         return False
 
-    async def _parse_header(self):
-        while True:
-            elements = (await self._reader.readline()).decode().strip().split(':', 1)
-            if len(elements) == 2:
-                self._headers[elements[0].strip().lower()] = elements[1].strip()
-            elif len(elements) == 1 and len(elements[0]) == 0:
-                if self._method == 'POST' or self._method == 'PUT':
-                    self._content_type = self._headers.get("content-type", None)
-                    self._content_length = (int)(self._headers.get('content-length', 0))
-                
-                TMiniWebServer.dlog(f"headers={self._headers}")
-                return True
-            else:
-                TMiniWebServer.log(f"_parse_header warning: {elements}")
+    def _parse_header(self):
+        head = self._head
+        server = self._server
+        start = self._head_start
+        end = len(head) - 4     ## 終端の空行を除く
+        if end - start > server.max_header_size or head.count(b'\r\n') - 2 > server.max_header_count:
+            self._parse_error = HttpStatusCode.REQUEST_HEADER_FIELDS_TOO_LARGE
+            return False
+        try:
+            self._headers = _RequestHeaders(head, start, end) if end > start else { }
+        except Exception as ex:
+            TMiniWebServer.elog("_parse_header warning: %s", ex)
+            return False
+
+        ## Keep-Alive で次のリクエストの位置を知るため、メソッドに関わらずボディ長を取得.
+        self._content_type = self._headers.get("content-type", None)
+        if 'chunked' in self._headers.get('transfer-encoding', '').lower():
+            self._request_chunked = True
+        else:
+            content_length = self._headers.get('content-length', '0')
+            if not content_length or content_length.strip('0123456789'):
+                ## 負の値や数字以外を許すと、ボディを次のリクエストとして扱ってしまう.
+                TMiniWebServer.elog('invalid content-length: %s', content_length)
+                self._keep_alive = False
+                self._parse_error = HttpStatusCode.BAD_REQUEST
                 return False
+            self._content_length = int(content_length)
+            self._content_remain = self._content_length
+        self._expect_continue = self._headers.get('expect', '').lower() == '100-continue'
+        self._keep_alive = self._check_keep_alive()
+
+        TMiniWebServer.dlog("headers=%s", self._headers)
+        return True
+
+    def _check_keep_alive(self):
+        server = self._server
+        if not server.keep_alive or self._request_count >= server.keep_alive_max_requests:
+            return False
+        connection = self._headers.get('connection', '').lower()
+        if self._http_ver == 'HTTP/1.1':
+            return 'close' not in connection
+        return 'keep-alive' in connection
 
     def _check_upgrade(self):
         if 'upgrade' in self._headers.get('connection', '').lower():
             return self._headers.get('upgrade', '').lower()
         return None
 
+    def _release_connection(self):
+        ## 長く続く WebSocket や Server-Sent Events の接続は、接続数の枠を返して HTTP の処理を妨げない.
+        if not self._connection_released:
+            self._connection_released = True
+            self._server._release_connection()
+
     async def _write_bad_request(self):
         await self.write_error_response(HttpStatusCode.BAD_REQUEST)
 
@@ -415,55 +1626,192 @@ class TMiniWebClient:
 
     async def _routing_http(self):
         TMiniWebServer.dlog('in _routing_http')
-        route, route_args = self._server._get_route_handler(self._req_path, self._method)
-        if self._method is None:
-            print(self._req_path)
-            print(self._path)
-            print(self._headers)
+        route = None
+        route_args = None
+        allowed_methods = None
+        handler, values, allowed = self._server._match_route(self._req_path, self._method)
+        if handler:
+            route = handler.func
+            route_args = self._server._get_route_args(handler, values)
+            self._route_key = handler.route
+        elif allowed:
+            allowed_methods = [m for m in allowed if m != 'WEBSOCKET']
 
         result = False
-        if route:
-            TMiniWebServer.dlog(f'found route: {self._req_path}, args: {route_args}')
+        if route and handler.options and handler.options.get('event_stream', False):
+            return await self._routing_event_stream(handler, route_args)
+        cache = self._server.response_cache
+        cache_key = None
+        cache_entry = None
+        if route and cache is not None and handler.options and self._method == 'GET':
+            cache_key = self._get_response_cache_key(handler.options)
+            cache_entry = cache.get(cache_key)
+            if cache_entry is None:
+                self._response_capture = []
+        if cache_entry is not None:
+            TMiniWebServer.dlog('response cache hit: %s', cache_key)
+            try:
+                await self._write_cached_response(cache_entry)
+                result = True
+            except Exception as ex:
+                self._keep_alive = False
+                TMiniWebServer.dlog("write cached response: %s", ex)
+        elif route:
+            TMiniWebServer.dlog('found route: %s, args: %s', self._req_path, route_args)
             try:
                 if route_args is not None:
                     await route(self, route_args)
                 else:
                     await route(self)
                 result = True
+                if self._response_capture and len(self._response_capture) == 1:
+                    head, tail, content = self._response_capture[0]
+                    expires = ticks_add(ticks_ms(), int(handler.options['cache_ttl'] * 1000))
+                    cache.put(cache_key, _CachedResponse(self._req_path, expires, head, tail, content))
             except Exception as ex:
-                TMiniWebServer.dlog(f"in _routeing_http: {ex}")
+                self._keep_alive = False
+                TMiniWebServer.dlog("in _routeing_http: %s", ex)
+                if self._server._error_handlers is not None:
+                    await self._call_error_handlers(ex)
+            if self._request_content_too_large and not self._response_started:
+                await self.write_error_response(HttpStatusCode.REQUEST_ENTITY_TOO_LARGE)
+            elif self._request_content_timed_out and not self._response_started:
+                await self.write_error_response(HttpStatusCode.REQUEST_TIMEOUT)
+            elif self._request_content_invalid and not self._response_started:
+                await self._write_bad_request()
+            if not self._response_started:
+                ## レスポンスを返さなかったハンドラーは接続を閉じて終端を知らせる.
+                self._keep_alive = False
+            elif result and self._response_stream is not None and not self._response_stream.is_ended():
+                ## 終端を送らずに戻ったストリームはここで閉じる. 接続を閉じる場合も chunked の終端は必要.
+                ## ハンドラーが例外で抜けたときは、途中で切れたことが分かるよう終端を送らない.
+                try:
+                    await self._response_stream.end()
+                except Exception as ex:
+                    self._keep_alive = False
+                    TMiniWebServer.dlog("end stream: %s", ex)
+        elif allowed_methods:
+            TMiniWebServer.dlog('method not allowed: %s, %s', self._method, allowed_methods)
+            await self.write_response(TMiniWebServer._http_status_messages[HttpStatusCode.METHOD_NOT_ALLOWED],
+                                      headers={ 'allow': ', '.join(allowed_methods) },
+                                      http_status=HttpStatusCode.METHOD_NOT_ALLOWED)
+            result = True
         else:
             TMiniWebServer.dlog('routing is not found.')
             if self._method.upper() == 'GET':
-                TMiniWebServer.dlog(f'search static files [{self._server._wwwroot}]')
-                file_phys_path, mime_type = self._server.get_phys_path_in_wwwroot(self._req_path)
+                self._route_key = '<static>'
+                TMiniWebServer.dlog('search static files [%s]', self._server._wwwroot)
+                entry = self._server._get_static_file(self._req_path)
+                if entry is not None and entry.gzip is not None and self._accepts_encoding('gzip'):
+                    entry = entry.gzip
 
-                if file_phys_path is None:
+                if entry is None:
                     await self.write_error_response(HttpStatusCode.NOT_FOUND)
-                    TMiniWebServer.log(f'fild not found [{self._req_path}]')
+                    TMiniWebServer.log('fild not found [%s]', self._req_path)
                 else:
-                    TMiniWebServer.dlog(f'file found [{mime_type}, {file_phys_path}]')
-                    await self.write_response_from_file(file_phys_path, content_type=mime_type)
+                    TMiniWebServer.dlog('file found [%s, %s]', entry.mime_type, entry.file_path)
+                    await self._write_static_file(entry)
 
                 result = True ## メソッドの処理結果としては正常の処理.
             else:
                 await self._write_bad_request()
                 result = True ## メソッドの処理結果としては正常の処理としておく.
+        await self._finish_request_content()
+        return result
+
+    async def _finish_request_content(self):
+        if self._keep_alive:
+            try:
+                await self._discard_request_content()
+            except Exception as ex:
+                self._keep_alive = False
+                TMiniWebServer.dlog("discard request content: %s", ex)
+
+    async def _routing_http_with_metrics(self):
+        start = ticks_ms()
+        if not self._server._use_middleware:
+            result = await self._routing_http()
+        else:
+            result = await self._routing_http_with_middleware()
+        self._server.metrics.record_request(self._route_key or '<other>', self._status_code or 0, ticks_diff(ticks_ms(), start))
+        return result
+
+    async def _routing_http_with_middleware(self):
+        server = self._server
+        result = True
         try:
-            self._writer.close()
-            await self._writer.wait_closed()
+            for func in server._before_request:
+                await func(self)
+                if self._response_started:
+                    break
         except Exception as ex:
-            sys.print_exception(ex)
-            pass
+            self._keep_alive = False
+            TMiniWebServer.dlog("in before_request: %s", ex)
+            if server._error_handlers is not None:
+                await self._call_error_handlers(ex)
+            if not self._response_started:
+                await self._write_internal_server_error()
+        if self._response_started:
+            ## ミドルウェアが応答したので、ハンドラーは呼ばない.
+            await self._finish_request_content()
+        else:
+            result = await self._routing_http()
+        for func in server._after_request:
+            try:
+                await func(self)
+            except Exception as ex:
+                TMiniWebServer.elog("in after_request: %s", ex)
         return result
 
+    async def _call_error_handlers(self, ex):
+        for func in self._server._error_handlers:
+            try:
+                await func(self, ex)
+            except Exception as ex2:
+                TMiniWebServer.elog("in on_error: %s", ex2)
+
+    async def _routing_event_stream(self, handler, route_args):
+        TMiniWebServer.dlog('in _routing_event_stream: %s', self._req_path)
+        ## 終端はいつまでも来ないので、ボディの長さは送らずに接続を閉じて終わる.
+        self._keep_alive = False
+        self._release_connection()
+        channel = self._server._event_channels[handler.route]
+        self._write_status_code(HttpStatusCode.OK)
+        self._write_content_type_header('text/event-stream', 'UTF-8')
+        self._write_headers({ 'cache-control': 'no-cache' }, None, None, None)
+        self._send_response_header()
+        stream = TMiniWebEventStream(self, channel)
+        metrics = self._server.metrics
+        if metrics is not None:
+            metrics.event_streams_active += 1
+        try:
+            await self._writer.drain()
+            stream._replay(self._headers.get('last-event-id', None))
+            if route_args is not None:
+                await handler.func(stream, route_args)
+            else:
+                await handler.func(stream)
+            await stream._serve(self._server.event_stream_heartbeat)
+        except Exception as ex:
+            TMiniWebServer.dlog('event stream closed: %s', ex)
+        finally:
+            stream._closed = True
+            channel.remove(stream)
+            if metrics is not None:
+                metrics.event_streams_active -= 1
+        return True
+
     async def _routing_websocket(self):
         TMiniWebServer.dlog('in _routing_websocket')
-        route, route_args = self._server._get_route_handler(self._req_path, 'websocket')
-        if not route:
-            TMiniWebServer.dlog(f'not found websocket route. [{self._req_path}]')
+        self._keep_alive = False
+        server = self._server
+        handler, values, _ = server._match_route(self._req_path, 'WEBSOCKET')
+        if not handler:
+            TMiniWebServer.dlog('not found websocket route. [%s]', self._req_path)
             await self._write_bad_request()
             return True
+        route = handler.func
+        route_args = server._get_route_args(handler, values)
 
         websocket = TMiniWebSocket(self)
         try:
@@ -472,19 +1820,332 @@ class TMiniWebClient:
                 return True
         except:
             return False
+        self._release_connection()
+
+        options = handler.options or { }
+        ping_interval = options.get('ping_interval', None)
+        pong_timeout = options.get('pong_timeout', None)
+        websocket._ping_interval = server.websocket_ping_interval if ping_interval is None else ping_interval
+        websocket._pong_timeout = server.websocket_pong_timeout if pong_timeout is None else pong_timeout
+        if websocket._ping_interval:
+            server._ping_scheduler.add(websocket)
+        metrics = server.metrics
+        if metrics is not None:
+            metrics.websockets_active += 1
+            metrics.websockets_total += 1
         
         try:
-            TMiniWebServer.dlog(f'found route: {self._req_path}, args: {route_args}')
+            TMiniWebServer.dlog('found route: %s, args: %s', self._req_path, route_args)
             if route_args:
                 await route(websocket, route_args)
             else:
                 await route(websocket)
         except Exception as ex:
-            TMiniWebServer.log(ex)
+            TMiniWebServer.elog('%s', ex)
             return False
+        finally:
+            websocket._detach()
+            if metrics is not None:
+                metrics.websockets_active -= 1
         
         return True
 
+class _RequestContentIterator:
+    def __init__(self, client, chunk_size):
+        self._client = client
+        self._chunk_size = chunk_size
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self._client.read_request_content_chunk(self._chunk_size)
+        if not data:
+            raise StopAsyncIteration
+        return data
+
+class TMiniWebResponseStream:
+    _last_chunk = b'0\r\n\r\n'
+
+    def __init__(self, client, chunked, charset):
+        self._client = client
+        self._chunked = chunked
+        self._charset = charset
+        self._ended = False
+        self._failed = False    ## 書き込みに失敗した. 終端は送らない.
+
+    def is_ended(self):
+        return self._ended
+
+    async def write(self, data):
+        ## 書き込む毎に drain するので、相手が受け取るまで待たされる(バックプレッシャー).
+        if self._ended:
+            return
+        if type(data) == str:
+            data = data.encode(self._charset)
+        if not data:
+            return
+        writer = self._client._writer
+        try:
+            if not self._chunked:
+                writer.write(data)
+            elif len(data) <= self._client._server.response_coalesce_size:
+                chunk = bytearray(f'{len(data):x}\r\n'.encode())
+                chunk.extend(data)
+                chunk.extend(b'\r\n')
+                writer.write(chunk)
+            else:
+                writer.write(f'{len(data):x}\r\n'.encode())
+                writer.write(data)
+                writer.write(b'\r\n')
+            await writer.drain()
+        except:
+            self._failed = True
+            self._client._keep_alive = False
+            raise
+
+    async def end(self):
+        if self._ended or self._failed:
+            return
+        self._ended = True
+        if self._chunked:
+            try:
+                self._client._writer.write(self._last_chunk)
+                await self._client._writer.drain()
+            except:
+                self._failed = True
+                self._client._keep_alive = False
+                raise
+
+class _EventChannel:
+    ## event_stream のパス毎の配信先と、再接続時に送り直すための直近のイベント.
+    def __init__(self, replay_size):
+        self._replay_size = replay_size
+        self._replay = []       ## [(id, 送信する形にしたイベント)]
+        self._streams = []
+        self._next_id = 1
+
+    def remove(self, stream):
+        if stream in self._streams:
+            self._streams.remove(stream)
+
+    def publish(self, data, event, id, queue_size):
+        if id is None:
+            id = str(self._next_id)
+            self._next_id += 1
+        frame = TMiniWebEventStream._encode(data, event, id)
+        if self._replay_size:
+            if len(self._replay) >= self._replay_size:
+                self._replay.pop(0)
+            self._replay.append((id, frame))
+        count = 0
+        for stream in self._streams:
+            if stream._enqueue(frame, queue_size):
+                count += 1
+        return count
+
+class TMiniWebEventStream:
+    ## Server-Sent Events の接続. ハンドラーは send で自分だけにイベントを送れる.
+    _heartbeat = b':\n\n'
+
+    def __init__(self, client, channel):
+        self._client = client
+        self._channel = channel
+        self._closed = False
+        self._queue = []
+        self._queue_event = asyncio.Event()
+        self.last_event_id = client._headers.get('last-event-id', None)
+
+    def is_closed(self):
+        return self._closed
+
+    async def send(self, data, event = None, id = None):
+        if self._closed:
+            return
+        try:
+            self._client._writer.write(TMiniWebEventStream._encode(data, event, id))
+            await self._client._writer.drain()
+        except:
+            self._closed = True
+            raise
+
+    @staticmethod
+    def _encode(data, event, id):
+        lines = []
+        if id is not None:
+            lines.append(f'id: {id}\n')
+        if event is not None:
+            lines.append(f'event: {event}\n')
+        for line in str(data).split('\n'):
+            lines.append(f'data: {line}\n')
+        lines.append('\n')
+        return ''.join(lines).encode()
+
+    def _replay(self, last_event_id):
+        ## Last-Event-ID より後のイベントを先に送る. 見つからなければ残っている分をすべて送る.
+        replay = self._channel._replay
+        start = 0
+        if last_event_id is not None:
+            for i, item in enumerate(replay):
+                if item[0] == last_event_id:
+                    start = i + 1
+                    break
+            self._queue.extend(frame for _, frame in replay[start:])
+        self._channel._streams.append(self)
+
+    def _enqueue(self, frame, queue_size):
+        if self._closed:
+            return False
+        if len(self._queue) >= queue_size:
+            ## 追いつけないクライアントは切断する. ブラウザは Last-Event-ID を付けて再接続してくる.
+            TMiniWebServer.elog('event stream queue is full. disconnect.')
+            self._closed = True
+            self._queue_event.set()
+            return False
+        self._queue.append(frame)
+        self._queue_event.set()
+        return True
+
+    async def _serve(self, heartbeat):
+        ## 接続のタスクがそのまま送信を受け持つので、クライアント毎のタスクは増えない.
+        writer = self._client._writer
+        queue = self._queue
+        while not self._closed:
+            if queue:
+                while queue:
+                    writer.write(queue.pop(0))
+                await writer.drain()
+                continue
+            self._queue_event.clear()
+            try:
+                await _wait(self._queue_event.wait(), heartbeat)
+            except asyncio.TimeoutError:
+                writer.write(TMiniWebEventStream._heartbeat)
+                await writer.drain()
+
+class _WebSocketFragmentIterator:
+    ## receive_stream が返すイテレーター. メッセージの最後のフレームまで順に返す.
+    def __init__(self, websocket, payload, fin):
+        self._websocket = websocket
+        self._payload = payload
+        self._fin = fin
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        payload = self._payload
+        if payload is not None:
+            self._payload = None
+            return payload
+        websocket = self._websocket
+        if self._fin or websocket.is_closed():
+            raise StopAsyncIteration
+        fin, opcode, payload = await websocket._read_data_frame()
+        if opcode != websocket.Opcode.CONTINUE:
+            self._fin = True
+            websocket._fragments = None
+            if opcode is not None:
+                await websocket._close_by_error(websocket.CloseCode.PROTOCOL_ERROR, 'continuation frame is expected')
+            raise StopAsyncIteration
+        if fin:
+            self._fin = True
+            websocket._fragments = None
+        return payload
+
+class _WebSocketPingScheduler:
+    ## PING を送る WebSocket を1つのタスクでまとめて見回る.
+    ## 受信が ping_interval 秒途絶えたら PING を送り、pong_timeout 秒以内に PONG が無ければ切断する.
+    _tick = 1   ## 見回る間隔(秒)
+
+    def __init__(self):
+        self._websockets = []
+        self._task = None
+
+    def add(self, websocket):
+        self._websockets.append(websocket)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def remove(self, websocket):
+        if websocket in self._websockets:
+            self._websockets.remove(websocket)
+
+    async def _run(self):
+        try:
+            while self._websockets:
+                await asyncio.sleep(self._tick)
+                now = ticks_ms()
+                for websocket in list(self._websockets):
+                    if websocket.is_closed():
+                        self.remove(websocket)
+                    elif not websocket._reading:
+                        ## PONG は受信の中で処理するので、ハンドラーが受信を待っていない間は見送る.
+                        continue
+                    elif websocket._ping_sent is not None:
+                        ## 受信を再開した直後は、届いている PONG を読むまで待つ.
+                        timeout = websocket._pong_timeout * 1000
+                        if ticks_diff(now, websocket._ping_sent) > timeout and ticks_diff(now, websocket._read_started) > timeout:
+                            TMiniWebServer.elog('WebSocket pong timeout.')
+                            self.remove(websocket)
+                            websocket._abort()
+                    elif ticks_diff(now, websocket._last_received) >= websocket._ping_interval * 1000:
+                        websocket._send_ping(now)
+        finally:
+            self._task = None
+
+class TMiniWebSocketHub:
+    ## WebSocket のチャンネル配信. publish したメッセージは1度だけフレームにして、
+    ## 各クライアントのキューへ同じものを入れる. 送信はクライアント毎のタスクが行うので、
+    ## 遅いクライアントがいても他のクライアントや publish する側は待たされない.
+    DROP_OLDEST = 0     ## キューが一杯なら一番古いフレームを捨てる
+    DISCONNECT = 1      ## キューが一杯なら接続を閉じる
+
+    def __init__(self, queue_size = 8, policy = DROP_OLDEST):
+        self.queue_size = queue_size
+        self.policy = policy
+        self._channels = { }    ## チャンネル名 -> [TMiniWebSocket]
+
+    def join(self, channel, websocket):
+        members = self._channels.get(channel, None)
+        if members is None:
+            members = []
+            self._channels[channel] = members
+        if websocket not in members:
+            members.append(websocket)
+            websocket._channels.append(channel)
+            websocket._start_queue()
+
+    def leave(self, channel, websocket):
+        members = self._channels.get(channel, None)
+        if members is not None and websocket in members:
+            members.remove(websocket)
+            websocket._channels.remove(channel)
+            if not members:
+                del self._channels[channel]
+
+    def leave_all(self, websocket):
+        for channel in list(websocket._channels):
+            self.leave(channel, websocket)
+
+    def get_count(self, channel):
+        members = self._channels.get(channel, None)
+        return len(members) if members else 0
+
+    def publish(self, channel, data, type = 1):
+        ## チャンネルの全員へ送る. 送信を予約したクライアントの数を返す.
+        members = self._channels.get(channel, None)
+        if not members:
+            return 0
+        opcode = TMiniWebSocket.Opcode.TEXT if type == TMiniWebSocket.MessageType.TEXT else TMiniWebSocket.Opcode.BINARY
+        frame = TMiniWebSocket._make_frame(opcode, data)
+        count = 0
+        ## DISCONNECT では送信中にチャンネルから外れるので、後ろから回す.
+        for i in range(len(members) - 1, -1, -1):
+            if members[i]._enqueue(frame, self.queue_size, self.policy):
+                count += 1
+        return count
+
 class TMiniWebSocket:
     class Opcode:
         CONTINUE = 0
@@ -496,22 +2157,121 @@ class TMiniWebSocket:
     class MessageType:
         TEXT = 1
         BINARY = 2
+    class CloseCode:
+        NORMAL = 1000
+        PROTOCOL_ERROR = 1002
+        POLICY_VIOLATION = 1008
+        MESSAGE_TOO_BIG = 1009
     
     def __init__(self, client):
         self._client = client
         self._closed = False
-        pass
+        self._fragments = None  ## 読み終わっていない receive_stream のイテレーター
+        self._channels = []     ## 参加しているチャンネル
+        self._send_queue = None ## チャンネル配信のフレームのキュー
+        self._queue_event = None
+        self._queue_task = None
+        self._send_lock = asyncio.Lock()    ## 分割送信の途中に他のデータフレームが割り込まないようにする
+        self._write_lock = asyncio.Lock()   ## 書き込みと drain を1フレームずつ行う. 制御フレームも含めてすべてのフレームで取る
+        self._ping_interval = 0
+        self._pong_timeout = 0
+        self._ping_sent = None  ## 応答待ちの PING を送った時刻
+        self._last_received = ticks_ms()
+        self._reading = False   ## フレームの受信を待っている. PING はこの間だけ送る
+        self._read_started = 0
+        self.latency = None     ## 最後に PING を送ってから PONG を受け取るまでの時間(ミリ秒)
 
     def is_closed(self):
         return self._closed
     
-    async def close(self):
+    async def close(self, code = None):
         try:
-            await self._send_core(self.Opcode.CLOSE, b'')
+            ## 制御フレームは分割送信の途中に挟んでもよいので、_send_lock は取らない.
+            await self._send_frame(self.Opcode.CLOSE, code.to_bytes(2, 'big') if code else b'')
         except:
             pass
         self._closed = True
 
+    def join(self, channel):
+        ## チャンネルに参加して TMiniWebSocketHub.publish の配信を受ける.
+        self._client._server.websocket_hub.join(channel, self)
+
+    def leave(self, channel):
+        self._client._server.websocket_hub.leave(channel, self)
+
+    def _start_queue(self):
+        if self._queue_task is None:
+            self._send_queue = []
+            self._queue_event = asyncio.Event()
+            self._queue_task = asyncio.create_task(self._drain_queue())
+
+    def _enqueue(self, frame, queue_size, policy):
+        if self.is_closed():
+            return False
+        queue = self._send_queue
+        if len(queue) >= queue_size:
+            if policy == TMiniWebSocketHub.DISCONNECT:
+                ## 追いつけないクライアントは CLOSE も受け取れないので、すぐに接続を閉じてチャンネルから外す.
+                ## 止まっている drain や receive() は接続が閉じられたことで抜ける.
+                TMiniWebServer.elog('WebSocket send queue is full. disconnect.')
+                queue.clear()
+                self._client._server.websocket_hub.leave_all(self)
+                self._abort()
+                self._queue_event.set()
+                return False
+            queue.pop(0)
+        queue.append(frame)
+        self._queue_event.set()
+        return True
+
+    async def _drain_queue(self):
+        queue = self._send_queue
+        while True:
+            if not queue:
+                if self.is_closed():
+                    break
+                self._queue_event.clear()
+                await self._queue_event.wait()
+                continue
+            frame = queue.pop(0)
+            async with self._send_lock:
+                await self._write_frame(frame)
+
+    def _send_ping(self, now):
+        ## 見回りのタスクを遅いクライアントの書き込みで止めないよう、送信は別のタスクで行う.
+        ## PONG の待ち時間は送信を待っている間も数える.
+        self._ping_sent = now
+        asyncio.create_task(self._write_ping())
+
+    async def _write_ping(self):
+        ## 制御フレームは分割送信の途中でも送ってよいので、_send_lock は取らない.
+        try:
+            async with self._write_lock:
+                if not self.is_closed():
+                    await self._write(TMiniWebSocket._make_frame(self.Opcode.PING, b''))
+        except Exception as ex:
+            TMiniWebServer.elog('WebSocket ping failed. (%s)', ex)
+            self._abort()
+
+    def _abort(self):
+        ## 応答の無い相手とは close のやり取りをせずに接続を閉じる.
+        self._closed = True
+        try:
+            self._client._writer.close()
+        except:
+            pass
+
+    def _detach(self):
+        ## ハンドラーを抜けたときに、チャンネルから外して送信タスクを止める.
+        if self._ping_interval:
+            self._client._server._ping_scheduler.remove(self)
+        if self._channels:
+            self._client._server.websocket_hub.leave_all(self)
+        if self._queue_task is not None:
+            self._queue_task.cancel()
+            self._queue_task = None
+            self._send_queue = None
+
     async def handshake(self):
         websocket_key = self._client._headers.get('sec-websocket-key', None)
         if websocket_key is None:
@@ -525,61 +2285,211 @@ class TMiniWebSocket:
             return True
 
     async def receive(self):
+        ## 分割されたメッセージは結合して返す.
+        message = None
+        message_opcode = None
         while not self.is_closed():
             try:
-                opcode, payload = await self._read_frame()
-                send_opcode, data = self._process_frame(opcode, payload)
-                if self.is_closed():
+                await self._skip_fragments()
+                fin, opcode, payload = await self._read_data_frame()
+                if opcode is None:
+                    break
+                if opcode == self.Opcode.CONTINUE:
+                    if message is None:
+                        await self._close_by_error(self.CloseCode.PROTOCOL_ERROR, 'unexpected continuation frame')
+                        break
+                    if len(message) + len(payload) > self._client._server.websocket_max_message_size:
+                        await self._close_by_error(self.CloseCode.MESSAGE_TOO_BIG, 'message is too large')
+                        break
+                    message.extend(payload)
+                elif message is not None:
+                    await self._close_by_error(self.CloseCode.PROTOCOL_ERROR, 'continuation frame is expected')
+                    break
+                else:
+                    message = payload
+                    message_opcode = opcode
+                if not fin:
                     continue
-
-                if send_opcode:
-                    await self._send_core(send_opcode, data)
-                elif data:
-                    if opcode == self.Opcode.BINARY:
-                        return data, self.MessageType.BINARY
-                    elif opcode == self.Opcode.TEXT:
-                        return data, self.MessageType.TEXT
+                if message:
+                    if message_opcode == self.Opcode.BINARY:
+                        return message, self.MessageType.BINARY
+                    elif message_opcode == self.Opcode.TEXT:
+                        return str(message, 'utf-8'), self.MessageType.TEXT
+                message = None
             except Exception as ex:
                 self._closed = True
-                TMiniWebServer.log(f'WebSocket closed. (exception : {ex})')
+                TMiniWebServer.elog('WebSocket closed. (exception : %s)', ex)
                 return None, None
         return None, None
 
+    async def receive_stream(self):
+        ## 次のメッセージを、届いたフレーム毎に bytearray で返す非同期イテレーターと種類を返す.
+        ## テキストでも UTF-8 の文字の途中で分かれていることがあるので、デコードは呼び出し側で行う.
+        try:
+            await self._skip_fragments()
+            while not self.is_closed():
+                fin, opcode, payload = await self._read_data_frame()
+                if opcode is None:
+                    break
+                if opcode == self.Opcode.CONTINUE:
+                    await self._close_by_error(self.CloseCode.PROTOCOL_ERROR, 'unexpected continuation frame')
+                    break
+                fragments = _WebSocketFragmentIterator(self, payload, fin)
+                if not fin:
+                    self._fragments = fragments
+                if opcode == self.Opcode.BINARY:
+                    return fragments, self.MessageType.BINARY
+                return fragments, self.MessageType.TEXT
+        except Exception as ex:
+            self._closed = True
+            TMiniWebServer.elog('WebSocket closed. (exception : %s)', ex)
+        return None, None
+
     async def send(self, data, type = MessageType.TEXT):
         if type == self.MessageType.TEXT:
             await self._send_core(self.Opcode.TEXT, data)
         if type == self.MessageType.BINARY:
             await self._send_core(self.Opcode.BINARY, data)
 
+    async def send_stream(self, source, type = MessageType.BINARY):
+        ## source の内容を分割したフレームで送る. source はイテレーター、非同期イテレーター、
+        ## または readinto を持つファイル. ファイルは送信バッファの大きさずつ送る.
+        async with self._send_lock:
+            await self._send_stream(source, type)
+
+    async def _send_stream(self, source, type):
+        opcode = self.Opcode.TEXT if type == self.MessageType.TEXT else self.Opcode.BINARY
+        if hasattr(source, 'readinto'):
+            buffer_pool = self._client._server._file_buffers
+            buffer = await buffer_pool.acquire()
+            try:
+                view = memoryview(buffer)
+                while not self.is_closed():
+                    read_size = source.readinto(buffer)
+                    if not read_size:
+                        break
+                    await self._send_frame(opcode, view[:read_size], False)
+                    opcode = self.Opcode.CONTINUE
+            finally:
+                buffer_pool.release(buffer)
+        elif hasattr(source, '__aiter__'):
+            async for data in source:
+                await self._send_frame(opcode, data, False)
+                opcode = self.Opcode.CONTINUE
+        else:
+            for data in source:
+                await self._send_frame(opcode, data, False)
+                opcode = self.Opcode.CONTINUE
+        ## 最後かどうかは読んでみるまで分からないので、空のフレームで終端を送る.
+        await self._send_frame(opcode, b'', True)
+
+    async def _read_data_frame(self):
+        ## 制御フレームはここで処理し、データフレームを (fin, opcode, payload) で返す.
+        ## 接続が閉じられたときは opcode が None.
+        timeout = self._client._server.websocket_timeout
+        if self._ping_interval and not timeout:
+            ## PING を送っているなら、PONG すら返ってこない相手はここでも見切る.
+            timeout = self._ping_interval + self._pong_timeout + _WebSocketPingScheduler._tick
+        while not self.is_closed():
+            self._reading = True
+            self._read_started = ticks_ms()
+            try:
+                fin, opcode, payload = await _wait(self._read_frame(), timeout)
+            except asyncio.TimeoutError:
+                TMiniWebServer.elog('WebSocket timeout.')
+                await self.close()
+                break
+            finally:
+                self._reading = False
+            self._last_received = ticks_ms()
+            if opcode == self.Opcode.PING:
+                await self._send_frame(self.Opcode.PONG, payload)
+            elif opcode == self.Opcode.PONG:
+                if self._ping_sent is not None:
+                    self.latency = ticks_diff(self._last_received, self._ping_sent)
+                    self._ping_sent = None
+            elif opcode == self.Opcode.CLOSE:
+                await self.close()
+            else:
+                return fin, opcode, payload
+        return None, None, None
+
+    async def _skip_fragments(self):
+        ## receive_stream で読み残したフレームを読み捨てる.
+        fragments = self._fragments
+        if fragments is not None:
+            async for _ in fragments:
+                pass
+
+    async def _close_by_error(self, code, message):
+        TMiniWebServer.elog('WebSocket error: %s', message)
+        await self.close(code)
+
     async def _send_upgrade_response(self, response_key):
         self._client._write_status_code(HttpStatusCode.SWITCH_PROTOCOLS)
         self._client._write_header('upgrade', 'websocket')
         self._client._write_header('connection', 'upgrade')
         self._client._write_header('sec-websocket-accept', response_key)
-        self._client._writer.write("\r\n")
+        self._client._end_headers()
+        self._client._send_response_header()
         await self._client._writer.drain()
 
-    async def _send_core(self, opcode, payload):
+    @staticmethod
+    def _make_frame_header(opcode, payload_length, fin = True):
+        frame = bytearray()
+        frame.append((0x80 if fin else 0) | int(opcode))
+        if payload_length < 126:
+            frame.append(payload_length)
+        elif payload_length < (1 << 16):
+            frame.append(126)
+            frame.extend(payload_length.to_bytes(2, 'big'))
+        else:
+            frame.append(127)
+            frame.extend(payload_length.to_bytes(8, 'big'))
+        return frame
+
+    @staticmethod
+    def _make_frame(opcode, payload):
+        ## 送信できる形にしたフレーム全体. チャンネル配信ではこれを全員で共有する.
+        if isinstance(payload, str):
+            payload = payload.encode()
+        frame = TMiniWebSocket._make_frame_header(opcode, len(payload))
+        frame.extend(payload)
+        return bytes(frame)
+
+    async def _send_core(self, opcode, payload, fin = True):
+        ## データフレームは、分割送信しているメッセージが終わるまで待ってから送る.
+        async with self._send_lock:
+            await self._send_frame(opcode, payload, fin)
+
+    async def _send_frame(self, opcode, payload, fin = True):
         if self.is_closed():
             return
-        try:
-            frame = bytearray()
-            frame.append(0x80 | int(opcode))
-            if opcode == self.Opcode.TEXT:
-                payload = payload.encode()
-
-            payload_length = len(payload)        
-            if payload_length < 126:
-                frame.append(payload_length)
-            elif payload_length < (1 << 16):
-                frame.append(126)
-                frame.extend(payload_length.to_bytes(2, 'big'))
-            else:
-                frame.append(127)
-                frame.extend(payload_length.to_bytes(8, 'big'))
+        if isinstance(payload, str):
+            payload = payload.encode()
+        frame = TMiniWebSocket._make_frame_header(opcode, len(payload), fin)
+        if len(payload) <= self._client._server.response_coalesce_size:
             frame.extend(payload)
-            self._client._writer.write(frame)
-            await self._client._writer.drain()
+            payload = None
+        async with self._write_lock:
+            ## 待っている間に閉じられたら、CLOSE の後にフレームを送らない.
+            if not self.is_closed():
+                ## 大きなペイロードはコピーせずにそのまま書き込む.
+                await self._write(frame, payload)
+
+    async def _write_frame(self, frame):
+        async with self._write_lock:
+            await self._write(frame)
+
+    async def _write(self, frame, payload = None):
+        ## drain は送信バッファの内容をまとめて送るので、他のタスクの書き込みと重ねてはいけない.
+        ## _write_lock を取ってから呼ぶ.
+        try:
+            writer = self._client._writer
+            writer.write(frame)
+            if payload is not None:
+                writer.write(payload)
+            await writer.drain()
         except OSError as ex:
             if ex.errno == 104: ## ECONNREST
                 self._closed = True
@@ -588,9 +2498,13 @@ class TMiniWebSocket:
             sys.print_exception(ex)
 
     async def _read_frame(self):
-        header = await self._client._reader.read(2)
+        reader = self._client._reader
+        try:
+            header = await reader.readexactly(2)
+        except EOFError:
+            header = b''
         if len(header) != 2:
-            TMiniWebServer.log('Invalid WebSocket frame header')
+            TMiniWebServer.elog('Invalid WebSocket frame header')
             raise OSError(32, 'WebSocket connection closed')
         ## ヘッダのパース.
         fin = header[0] & 0x80 > 0
@@ -598,27 +2512,25 @@ class TMiniWebSocket:
         has_mask = header[1] & 0x80 > 0
         length = header[1] & 0x7F
 
-        if length < 0:
-            length = await self._client._reader.read(-length)
-            length = int.from_bytes(length, 'big')
+        if length == 126:
+            length = int.from_bytes(await reader.readexactly(2), 'big')
+        elif length == 127:
+            length = int.from_bytes(await reader.readexactly(8), 'big')
+        if length > self._client._server.websocket_max_frame_size:
+            TMiniWebServer.elog('WebSocket frame is too large. (%s)', length)
+            await self.close(self.CloseCode.MESSAGE_TOO_BIG)
+            raise ValueError('WebSocket frame is too large')
         if has_mask:
-            mask = await self._client._reader.read(4)
-        payload = await self._client._reader.read(length)
+            mask = await reader.readexactly(4)
+        ## ペイロードはフレーム毎に確保したバッファへ直接読み込み、その場でマスクを解除する.
+        payload = bytearray(length)
+        view = memoryview(payload)
+        received = 0
+        while received < length:
+            read_size = await reader.readinto(view[received:])
+            if not read_size:
+                raise OSError(32, 'WebSocket connection closed')
+            received += read_size
         if has_mask:
-            payload = bytes( x ^ mask[i % 4] for i, x, in enumerate(payload))
-        return opcode, payload
-    
-    def _process_frame(self, opcode, payload):
-        if opcode == self.Opcode.TEXT:
-            payload = payload.decode()
-        elif opcode == self.Opcode.BINARY:
-            pass
-        elif opcode == self.Opcode.CLOSE:
-            self._closed = True
-            pass 
-        elif opcode == self.Opcode.PING:
-            return self.Opcode.PONG, payload
-        elif opcode == self.Opcode.PONG:
-            return None, None
-        return None, payload
-
+            _websocket_unmask(payload, length, mask)
+        return fin, opcode, payload
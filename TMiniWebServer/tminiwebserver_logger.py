@@ -0,0 +1,116 @@
+import uasyncio as asyncio
+from time import time, gmtime
+
+class TMiniWebLogger:
+    ## レベルで絞り込んでから記録するロガー. メッセージは '%' 形式の引数のまま保持し、
+    ## 表示やファイル出力、読み出しのときに初めて文字列にする.
+    ## 記録は固定長のリングバッファに残り、print_level 以上のものだけをすぐに表示する.
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+    _level_names = { DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR' }
+    _scalar_types = (str, int, float, bool, type(None))   ## そのまま保持しても他のオブジェクトを残さない型
+
+    def __init__(self, level = INFO, print_level = WARNING, ring_size = 32):
+        self.level = level
+        self.print_level = print_level
+        self._ring = [None] * ring_size
+        self._count = 0     ## これまでに記録した数
+        self._flushed = 0   ## ファイルへ書き出した数
+        self._flush_task = None
+
+    def configure(self, level, print_level, ring_size):
+        self.level = level
+        self.print_level = print_level
+        if ring_size != len(self._ring):
+            self._ring = [None] * ring_size
+            self._count = 0
+            self._flushed = 0
+
+    def is_enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, message, *args):
+        if level >= self.level:
+            self._emit(level, message, args, level >= self.print_level)
+
+    def debug(self, message, *args):
+        if self.DEBUG >= self.level:
+            self._emit(self.DEBUG, message, args, self.DEBUG >= self.print_level)
+
+    def info(self, message, *args):
+        if self.INFO >= self.level:
+            self._emit(self.INFO, message, args, self.INFO >= self.print_level)
+
+    def warning(self, message, *args):
+        if self.WARNING >= self.level:
+            self._emit(self.WARNING, message, args, self.WARNING >= self.print_level)
+
+    def error(self, message, *args):
+        if self.ERROR >= self.level:
+            self._emit(self.ERROR, message, args, self.ERROR >= self.print_level)
+
+    def _emit(self, level, message, args, show):
+        ring = self._ring
+        if ring and args:
+            ## 接続や例外などをリングバッファに残すと、それが参照するバッファまで解放されなくなる.
+            ## そのようなものだけは記録するときに文字列にしておく.
+            scalar_types = self._scalar_types
+            for arg in args:
+                if not isinstance(arg, scalar_types):
+                    args = tuple(arg if isinstance(arg, scalar_types) else str(arg) for arg in args)
+                    break
+        record = (time(), level, message, args)
+        if ring:
+            ring[self._count % len(ring)] = record
+            self._count += 1
+        if show:
+            print(TMiniWebLogger.format_record(record))
+
+    @staticmethod
+    def format_record(record):
+        t, level, message, args = record
+        if args:
+            try:
+                message = message % args
+            except Exception:
+                message = f'{message} {args}'
+        tm = gmtime(int(t))
+        return '%04d-%02d-%02d %02d:%02d:%02d [%s] %s' % (
+            tm[0], tm[1], tm[2], tm[3], tm[4], tm[5], TMiniWebLogger._level_names.get(level, level), message)
+
+    def get_records(self, start = 0):
+        ## start 番目以降で、リングバッファに残っている記録を古い順に返す.
+        size = len(self._ring)
+        first = max(start, self._count - size)
+        return [self._ring[i % size] for i in range(first, self._count)]
+
+    def get_lines(self):
+        return [TMiniWebLogger.format_record(record) for record in self.get_records()]
+
+    def flush(self, file_path):
+        ## 前回から増えた記録をまとめてファイルへ追記する.
+        records = self.get_records(self._flushed)
+        if not records:
+            return
+        dropped = self._count - self._flushed - len(records)
+        self._flushed = self._count
+        with open(file_path, 'a') as f:
+            if dropped:
+                f.write(f'... {dropped} records dropped\n')
+            for record in records:
+                f.write(TMiniWebLogger.format_record(record))
+                f.write('\n')
+
+    def start_flush_task(self, file_path, interval):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._run_flush(file_path, interval))
+
+    async def _run_flush(self, file_path, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.flush(file_path)
+            except Exception as ex:
+                print(f'log flush failed: {ex}')
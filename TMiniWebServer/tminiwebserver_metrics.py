@@ -0,0 +1,169 @@
+import gc
+from array import array
+from json import dumps
+
+class _RouteMetrics:
+    def __init__(self, bucket_count):
+        ## 最後の要素は上限を超えたもの(+Inf).
+        self.buckets = array('I', [0] * (bucket_count + 1))
+        self.count = 0
+        self.total_ms = 0
+
+class TMiniWebMetrics:
+    ## リクエスト数やレイテンシ、転送量、メモリの状態を集計する.
+    ## ルート毎のヒストグラムは最初のリクエストで確保し、以降の記録ではメモリを確保しない.
+    latency_buckets = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)    ## ミリ秒
+
+    def __init__(self):
+        self.routes = { }           ## ルートのパターン -> _RouteMetrics
+        self.status_counts = { }    ## ステータスコード -> 回数
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections_total = 0
+        self.connections_rejected = 0
+        self.websockets_active = 0
+        self.websockets_total = 0
+        self.event_streams_active = 0
+        self._server = None
+
+    def record_request(self, route, status, elapsed_ms):
+        metrics = self.routes.get(route, None)
+        if metrics is None:
+            metrics = _RouteMetrics(len(self.latency_buckets))
+            self.routes[route] = metrics
+        metrics.count += 1
+        metrics.total_ms += elapsed_ms
+        index = 0
+        for limit in self.latency_buckets:
+            if elapsed_ms <= limit:
+                break
+            index += 1
+        metrics.buckets[index] += 1
+        self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    def get_memory_info(self):
+        ## (空きメモリ, 確保できる最大の連続領域). 取得できない環境では None.
+        if not hasattr(gc, 'mem_free'):
+            return None, None
+        gc.collect()
+        free = gc.mem_free()
+        return free, TMiniWebMetrics._probe_largest_free(free)
+
+    @staticmethod
+    def _probe_largest_free(free):
+        ## 連続して確保できる大きさを二分探索で調べる. 重いので集計結果を返すときだけ使う.
+        low = 0
+        high = free
+        while high - low > 256:
+            size = (low + high) // 2
+            try:
+                buffer = bytearray(size)
+                del buffer
+                low = size
+            except MemoryError:
+                high = size
+        gc.collect()
+        return low
+
+    def _get_gauges(self):
+        server = self._server
+        free, largest_free = self.get_memory_info()
+        return {
+            'connections_active': server._connection_count if server else 0,
+            'websockets_active': self.websockets_active,
+            'event_streams_active': self.event_streams_active,
+            'heap_free_bytes': free,
+            'heap_largest_free_bytes': largest_free,
+        }
+
+    def to_json(self):
+        routes = { }
+        for route, metrics in self.routes.items():
+            routes[route] = {
+                'count': metrics.count,
+                'total_ms': metrics.total_ms,
+                'buckets': list(metrics.buckets),
+            }
+        result = {
+            'latency_buckets_ms': list(self.latency_buckets),
+            'routes': routes,
+            'status': { str(k): v for k, v in self.status_counts.items() },
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'connections_total': self.connections_total,
+            'connections_rejected': self.connections_rejected,
+            'websockets_total': self.websockets_total,
+        }
+        result.update(self._get_gauges())
+        return dumps(result)
+
+    def to_prometheus(self):
+        lines = []
+        lines.append('# TYPE tminiweb_request_duration_ms histogram')
+        for route, metrics in self.routes.items():
+            cumulative = 0
+            for i, limit in enumerate(self.latency_buckets):
+                cumulative += metrics.buckets[i]
+                lines.append(f'tminiweb_request_duration_ms_bucket{{route="{route}",le="{limit}"}} {cumulative}')
+            cumulative += metrics.buckets[-1]
+            lines.append(f'tminiweb_request_duration_ms_bucket{{route="{route}",le="+Inf"}} {cumulative}')
+            lines.append(f'tminiweb_request_duration_ms_sum{{route="{route}"}} {metrics.total_ms}')
+            lines.append(f'tminiweb_request_duration_ms_count{{route="{route}"}} {metrics.count}')
+        lines.append('# TYPE tminiweb_responses_total counter')
+        for status, count in self.status_counts.items():
+            lines.append(f'tminiweb_responses_total{{status="{status}"}} {count}')
+        for name, value in (('bytes_in', self.bytes_in), ('bytes_out', self.bytes_out),
+                            ('connections', self.connections_total),
+                            ('connections_rejected', self.connections_rejected),
+                            ('websockets', self.websockets_total)):
+            lines.append(f'# TYPE tminiweb_{name}_total counter')
+            lines.append(f'tminiweb_{name}_total {value}')
+        for name, value in self._get_gauges().items():
+            if value is not None:
+                lines.append(f'# TYPE tminiweb_{name} gauge')
+                lines.append(f'tminiweb_{name} {value}')
+        lines.append('')
+        return '\n'.join(lines)
+
+class _MetricsStream:
+    ## 接続のストリームを包んで、送受信したバイト数を数える. メトリクスが有効なときだけ使う.
+    def __init__(self, stream, metrics):
+        self._stream = stream
+        self._metrics = metrics
+
+    async def read(self, size = -1):
+        data = await self._stream.read(size)
+        self._metrics.bytes_in += len(data)
+        return data
+
+    async def readinto(self, buffer):
+        size = await self._stream.readinto(buffer)
+        if size:
+            self._metrics.bytes_in += size
+        return size
+
+    async def readexactly(self, size):
+        data = await self._stream.readexactly(size)
+        self._metrics.bytes_in += len(data)
+        return data
+
+    async def readline(self):
+        data = await self._stream.readline()
+        self._metrics.bytes_in += len(data)
+        return data
+
+    def write(self, data):
+        self._metrics.bytes_out += len(data)
+        return self._stream.write(data)
+
+    async def drain(self):
+        await self._stream.drain()
+
+    def close(self):
+        self._stream.close()
+
+    async def wait_closed(self):
+        await self._stream.wait_closed()
+
+    def get_extra_info(self, name):
+        return self._stream.get_extra_info(name)
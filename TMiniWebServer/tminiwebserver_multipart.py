@@ -0,0 +1,142 @@
+class TMiniWebMultipartPart:
+    def __init__(self, reader, headers):
+        self._reader = reader
+        self.headers = headers
+        self.name = None
+        self.filename = None
+        self.content_type = headers.get('content-type', None)
+        for param in headers.get('content-disposition', '').split(';')[1:]:
+            elements = param.split('=', 1)
+            if len(elements) == 2:
+                key = elements[0].strip().lower()
+                value = elements[1].strip()
+                if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+                    value = value[1:-1]
+                if key == 'name':
+                    self.name = value
+                elif key == 'filename':
+                    self.filename = value
+
+    async def read_chunk(self, size = 512):
+        ## パートの内容を最大 size バイト返す. パートの終わりに達すると b''.
+        return await self._reader._read_part_content(size)
+
+    async def read(self, max_size = 0):
+        ## パートの内容をすべて読み込む. max_size を超える場合は ValueError.
+        data = bytearray()
+        while True:
+            chunk = await self.read_chunk()
+            if not chunk:
+                return data
+            data.extend(chunk)
+            if max_size and len(data) > max_size:
+                raise ValueError('multipart part is too large')
+
+    async def save(self, file_path):
+        ## パートの内容をファイルへ書き込み、書き込んだバイト数を返す.
+        total = 0
+        with open(file_path, 'wb') as f:
+            while True:
+                chunk = await self.read_chunk()
+                if not chunk:
+                    return total
+                f.write(chunk)
+                total += len(chunk)
+
+    async def feed(self, callback):
+        ## パートの内容をチャンク毎に callback へ渡す.
+        total = 0
+        while True:
+            chunk = await self.read_chunk()
+            if not chunk:
+                return total
+            callback(chunk)
+            total += len(chunk)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.read_chunk()
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+class TMiniWebMultipartReader:
+    ## multipart/form-data のボディを少しずつ読み、パート毎に取り出す.
+    ## 境界がチャンクをまたいでも見つけられるよう、境界の長さ分だけ未確定のデータを残しておく.
+    max_header_size = 1024
+
+    def __init__(self, client, boundary, chunk_size = 512):
+        self._client = client
+        self._delimiter = b'\r\n--' + boundary.encode()
+        self._chunk_size = chunk_size
+        ## 最初の境界の前には CRLF が無いので、補って他の境界と同じ形で探す.
+        self._buffer = b'\r\n'
+        self._in_part = False
+        self._finished = False
+
+    async def next_part(self):
+        ## 次のパートを返す. パートが無くなると None.
+        if self._finished:
+            return None
+        while self._in_part:
+            ## 読まれなかった残りの内容は読み捨てる.
+            await self._read_part_content(self._chunk_size)
+
+        delimiter = self._delimiter
+        while True:
+            index = self._buffer.find(delimiter)
+            if index >= 0:
+                break
+            ## 最初の境界より前のプリアンブルは捨てる.
+            self._buffer = self._buffer[-(len(delimiter) - 1):]
+            await self._fill()
+        self._buffer = self._buffer[index + len(delimiter):]
+        while len(self._buffer) < 2:
+            await self._fill()
+        if self._buffer[:2] == b'--':
+            self._finished = True
+            return None
+
+        while True:
+            index = self._buffer.find(b'\r\n\r\n')
+            if index >= 0:
+                break
+            if len(self._buffer) > self.max_header_size:
+                raise ValueError('multipart header is too large')
+            await self._fill()
+        headers = { }
+        for line in self._buffer[:index].decode().split('\r\n'):
+            elements = line.split(':', 1)
+            if len(elements) == 2:
+                headers[elements[0].strip().lower()] = elements[1].strip()
+        self._buffer = self._buffer[index + 4:]
+        self._in_part = True
+        return TMiniWebMultipartPart(self, headers)
+
+    async def _read_part_content(self, size):
+        if not self._in_part:
+            return b''
+        delimiter = self._delimiter
+        while True:
+            buffer = self._buffer
+            index = buffer.find(delimiter)
+            if index >= 0:
+                if index == 0:
+                    self._in_part = False
+                    return b''
+                end = min(index, size)
+            else:
+                ## 末尾は次のチャンクと合わせて境界になるかもしれないので残す.
+                end = min(len(buffer) - (len(delimiter) - 1), size)
+            if end > 0:
+                self._buffer = buffer[end:]
+                return buffer[:end]
+            await self._fill()
+
+    async def _fill(self):
+        data = await self._client.read_request_content_chunk(self._chunk_size)
+        if not data:
+            raise ValueError('multipart content is truncated')
+        self._buffer += data
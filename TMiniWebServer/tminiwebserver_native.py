@@ -0,0 +1,19 @@
+import micropython
+
+## WebSocket のマスク解除のネイティブ版. 使えない環境では tminiwebserver.py の Python 版を使う.
+@micropython.viper
+def websocket_unmask(buf, length: int, mask):
+    m = ptr8(mask)
+    word = m[0] | (m[1] << 8) | (m[2] << 16) | (m[3] << 24)
+    ## bytearray の領域は 4 バイト境界に揃っているので、4 バイトずつ処理する.
+    words = ptr32(buf)
+    count = length >> 2
+    i = 0
+    while i < count:
+        words[i] ^= word
+        i += 1
+    b = ptr8(buf)
+    i = count << 2
+    while i < length:
+        b[i] ^= m[i & 3]
+        i += 1
@@ -1,26 +1,56 @@
 import gc
 import sys
 from os import stat
+from time import gmtime
 
 
+## 16進数字の値. 16進数字でないものは 0xff.
+_hex_values = bytes([
+    (c - 0x30) if 0x30 <= c <= 0x39 else
+    (c - 0x41 + 10) if 0x41 <= c <= 0x46 else
+    (c - 0x61 + 10) if 0x61 <= c <= 0x66 else 0xff
+    for c in range(256)])
+
+def _unquote(s, plus):
+    s = str(s)
+    if '%' not in s:
+        ## エンコードされた文字が無ければ変換不要.
+        return s.replace('+', ' ') if plus and '+' in s else s
+    src = s.encode()
+    size = len(src)
+    ## デコード後の長さは元の長さを超えないので、出力先は一度だけ確保する.
+    out = bytearray(size)
+    hex_values = _hex_values
+    i = 0
+    n = 0
+    while i < size:
+        c = src[i]
+        if c == 0x25 and i + 2 < size:      ## '%'
+            hi = hex_values[src[i + 1]]
+            lo = hex_values[src[i + 2]]
+            if hi != 0xff and lo != 0xff:
+                out[n] = (hi << 4) | lo
+                n += 1
+                i += 3
+                continue
+        elif c == 0x2b and plus:            ## '+'
+            c = 0x20
+        out[n] = c
+        n += 1
+        i += 1
+    try:
+        return str(out[:n], 'utf-8')
+    except:
+        return s
+
 class TMiniWebServerUtil:
     @staticmethod
     def unquote(s):
-        r = str(s).split('%')
-        try:
-            b = r[0].encode()
-            for i in range(1, len(r)):
-                try:
-                    b += bytes([int(r[i][:2], 16)]) + r[i][2:].encode()
-                except:
-                    b += b'%' + r[i].encode()
-            return b.decode('UTF-8')
-        except:
-            return str(s)
+        return _unquote(s, False)
     
     @staticmethod
     def unquote_plus(s):
-        return TMiniWebServerUtil.unquote(s.replace('+', ' '))
+        return _unquote(s, True)
     
     @staticmethod
     def escape_html(s):
@@ -48,6 +78,51 @@ class TMiniWebServerUtil:
                 return TMiniWebServerUtil._mime_types[ext]
         return 'application/octet-stream'
 
+    @staticmethod
+    def get_file_stat(path):
+        ## 存在しなければ None. is_exist_file と違い GC は発動しない.
+        try:
+            return stat(path)
+        except:
+            return None
+
+    @staticmethod
+    def format_http_date(seconds):
+        ## 'Sun, 06 Nov 1994 08:49:37 GMT' 形式の日付文字列.
+        t = gmtime(seconds)
+        return '%s, %02d %s %04d %02d:%02d:%02d GMT' % (
+            TMiniWebServerUtil._weekday_names[t[6]], t[2], TMiniWebServerUtil._month_names[t[1] - 1],
+            t[0], t[3], t[4], t[5])
+
+    @staticmethod
+    def parse_byte_range(value, size):
+        ## 'bytes=0-99', 'bytes=100-', 'bytes=-100' を (先頭, 末尾) に変換する.
+        ## 解釈できないものや複数範囲の指定は None (全体を送る)、範囲外は False を返す.
+        value = value.strip()
+        if not value.startswith('bytes=') or ',' in value:
+            return None
+        elements = value[6:].split('-')
+        if len(elements) != 2:
+            return None
+        first = elements[0].strip()
+        last = elements[1].strip()
+        if first and not first.isdigit() or last and not last.isdigit():
+            return None
+        if first:
+            first = int(first)
+            last = int(last) if last else size - 1
+            if first >= size:
+                return False
+            if last < first:
+                return None
+            return first, min(last, size - 1)
+        if not last:
+            return None
+        suffix = int(last)
+        if suffix == 0 or size == 0:
+            return False
+        return max(size - suffix, 0), size - 1
+
     @staticmethod
     def get_file_size(path):
         try:
@@ -57,6 +132,9 @@ class TMiniWebServerUtil:
             sys.print_exception(ex)
             return 0
 
+    _weekday_names = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+    _month_names = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
     _html_escape_chars = {
         "&" : "&amp;",
         '"' : "&quot;",
@@ -92,6 +170,71 @@ class TMiniWebServerUtil:
         '.bin' : 'application/octet-stream'
     }
 
+class TMiniWebQueryParams:
+    ## クエリ文字列や application/x-www-form-urlencoded の内容.
+    ## 最初に参照されたときに解析する. 同じ名前が複数あるとき、
+    ## get() や [] は最後の値を、get_list() はすべての値を返す.
+    def __init__(self, source, plus = False):
+        self._source = source
+        self._plus = plus
+        self._params = None
+
+    def _parse(self):
+        params = { }
+        if self._source:
+            for s in self._source.split('&'):
+                if not s:
+                    continue
+                param = s.split('=', 1)
+                name = _unquote(param[0], self._plus)
+                value = _unquote(param[1], self._plus) if len(param) > 1 else ''
+                values = params.get(name, None)
+                if values is None:
+                    params[name] = [value]
+                else:
+                    values.append(value)
+        self._params = params
+        self._source = None
+        return params
+
+    def _get_params(self):
+        params = self._params
+        return params if params is not None else self._parse()
+
+    def get(self, name, default = None):
+        values = self._get_params().get(name, None)
+        return values[-1] if values else default
+
+    def get_list(self, name):
+        return list(self._get_params().get(name, ()))
+
+    def __getitem__(self, name):
+        return self._get_params()[name][-1]
+
+    def __contains__(self, name):
+        return name in self._get_params()
+
+    def __len__(self):
+        return len(self._get_params())
+
+    def __iter__(self):
+        return iter(self._get_params())
+
+    def __bool__(self):
+        return len(self._get_params()) > 0
+
+    def keys(self):
+        return self._get_params().keys()
+
+    def values(self):
+        return [values[-1] for values in self._get_params().values()]
+
+    def items(self):
+        return [(name, values[-1]) for name, values in self._get_params().items()]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
 class HttpStatusCode:
     SWITCH_PROTOCOLS = 101
     OK = 200
@@ -128,6 +271,7 @@ class HttpStatusCode:
     UNSUPPORTED_MEDIA_TYPE = 415
     REQUESTED_RANGE_NOT_SATISFIABLE = 416
     EXPECTATION_FAILED = 417
+    REQUEST_HEADER_FIELDS_TOO_LARGE = 431
 
     INTERNAL_SERVER_ERROR = 500
     NOT_IMPLEMENTED = 501
@@ -8,12 +8,13 @@ from json import loads,dumps
 ##-------------------------------------------------------------------------
 ## REST API 向け
 ##-------------------------------------------------------------------------
-@TMiniWebServer.route('/article/<id>', method='GET')
+## 同じ内容を返す間は、応答を 5 秒間キャッシュして使い回す.
+@TMiniWebServer.route('/article/<int:id>', method='GET', cache_ttl=5)
 async def restapi_article_get(client, args):
     json_data = f"{{ 'id': {args['id']}, 'message': 'これは本文のテキストです。' }}"
     await client.write_response(content=json_data, content_type='application/json')
 
-@TMiniWebServer.route('/article/<id>', method='PUT')
+@TMiniWebServer.route('/article/<int:id>', method='PUT')
 async def restapi_article_put(client, args):
     data = await client.read_request_json_content()
     html = f"""<html>
@@ -25,6 +26,7 @@ async def restapi_article_put(client, args):
     </body>
     </html>
     """
+    client._server.invalidate_response_cache(client._req_path)
     await client.write_response(content=html)
 
 @TMiniWebServer.route('/article', method='POST')